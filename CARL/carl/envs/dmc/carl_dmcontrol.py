@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+from typing import Any, Hashable
+
+from collections import OrderedDict
+
+import numpy as np
 from gymnasium import spaces
 
 from carl.context.selection import AbstractSelector
 from carl.envs.carl_env import CARLEnv
 from carl.envs.dmc.loader import load_dmc_env
 from carl.envs.dmc.wrappers import MujocoToGymWrapper
-from carl.utils.types import Contexts
+from carl.utils.types import Context, Contexts
 
 
 class CARLDmcEnv(CARLEnv):
@@ -24,12 +29,22 @@ class CARLDmcEnv(CARLEnv):
 
     For descriptions of the other parameters see the parent class CARLEnv.
 
+    The compiled environments of the last `env_cache_size` contexts are kept,
+    so switching back to a context resets the cached environment instead of
+    rewriting the model XML and compiling a new physics.
+
+    If `render_size` is set to (height, width), frames are rendered at that
+    resolution instead of the default one of the camera.
+
     Raises
     ------
     NotImplementedError
         Dict observation spaces are not implemented for dm-control yet.
     """
 
+    env_cache_size: int = 128
+    render_size: tuple[int, int] | None = None
+
     def __init__(
         self,
         contexts: Contexts | None = None,
@@ -39,6 +54,7 @@ class CARLDmcEnv(CARLEnv):
         context_selector_kwargs: dict = None,
         **kwargs,
     ):
+        self._env_cache: OrderedDict[Hashable, MujocoToGymWrapper] = OrderedDict()
         # TODO can we have more than 1 env?
         env = load_dmc_env(
             domain_name=self.domain,
@@ -68,13 +84,34 @@ class CARLDmcEnv(CARLEnv):
         )  # allow to augment all values
 
     def _update_context(self) -> None:
-        env = load_dmc_env(
-            domain_name=self.domain,
-            task_name=self.task,
-            context=self.context,
-            environment_kwargs={"flat_observation": True},
-        )
-        self.env = MujocoToGymWrapper(env)
+        key = _freeze(self.context)
+        if key in self._env_cache:
+            self._env_cache.move_to_end(key)
+        else:
+            env = load_dmc_env(
+                domain_name=self.domain,
+                task_name=self.task,
+                context=self.context,
+                environment_kwargs={"flat_observation": True},
+            )
+            self._env_cache[key] = MujocoToGymWrapper(env)
+            while len(self._env_cache) > self.env_cache_size:
+                self._env_cache.popitem(last=False)
+        self.env = self._env_cache[key]
 
     def render(self):
-        return self.env.render(mode="rgb_array")
+        kwargs = {}
+        if self.render_size is not None:
+            kwargs = dict(zip(("height", "width"), self.render_size))
+        return self.env.render(mode="rgb_array", **kwargs)
+
+
+def _freeze(context: Context | Any) -> Hashable:
+    """Turn a context into a hashable key that compares equal for equal values."""
+    if isinstance(context, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in context.items()))
+    if isinstance(context, (list, tuple, np.ndarray)):
+        return tuple(_freeze(v) for v in context)
+    if isinstance(context, np.generic):
+        return context.item()
+    return context
@@ -183,3 +183,30 @@ class TestPointmass:
                 target_y=0.3,
                 area_size=0.6,
             )
+
+
+class TestDmcEnvCache:
+    def test_reuse_env_per_context(self):
+        contexts = {
+            0: {"gravity": -9.81},
+            1: {"gravity": -5.0},
+        }
+        env = CARLDmcWalkerEnv(contexts=contexts)
+        env.context = env.contexts[0]
+        env._update_context()
+        first = env.env
+        env.context = env.contexts[1]
+        env._update_context()
+        assert env.env is not first
+        env.context = env.contexts[0]
+        env._update_context()
+        assert env.env is first
+
+    def test_cache_size(self):
+        contexts = {i: {"gravity": -1.0 - i} for i in range(3)}
+        env = CARLDmcWalkerEnv(contexts=contexts)
+        env.env_cache_size = 2
+        for context in env.contexts.values():
+            env.context = context
+            env._update_context()
+        assert len(env._env_cache) == 2
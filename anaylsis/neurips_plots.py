@@ -15,8 +15,10 @@ from joblib import Parallel, delayed
 from sklearn.metrics import roc_auc_score
 import subprocess
 import time
-from utils import get_df_from_file
+import zlib
+from utils import cached, get_dataset_from_file, get_df_from_file
 
+from sklearn.decomposition import PCA
 from sklearn.model_selection import StratifiedKFold
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import AdaBoostClassifier
@@ -42,11 +44,52 @@ parser.add_argument(
 parser.add_argument(
     "--DEBUG", action="store_true", help="Run in debug mode with reduced computations."
 )
+parser.add_argument(
+    "--embedding",
+    choices=["tsne", "pca_tsne", "opentsne", "umap"],
+    default="tsne",
+    help="2D embedding of the grid plots. pca_tsne reduces to 50 dimensions "
+    "before t-SNE, opentsne (FFT gradients) and umap need their packages.",
+)
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default="cache_neurips",
+    help="Cache of embeddings and AUC scores keyed by their inputs.",
+)
+parser.add_argument(
+    "--no_cache", action="store_true", help="Always recompute embeddings and AUC scores."
+)
 args = parser.parse_args()
 
 OUTPUT_BASE_DIR = f"plots_neurips_{args.MASTER_SEED}"
+CACHE_DIR = None if args.no_cache else args.cache_dir
 Z_NAMES = [r"$\mathfrak{z}_" + str(j + 1) + "$" for j in range(8)]
 
+# Settings of the embeddings and the AUC ensemble. They are part of the cache
+# keys, so changing one recomputes the results instead of loading stale ones.
+# Bump CACHE_VERSION when the computation changes in a way they do not cover.
+CACHE_VERSION = 1
+EMBEDDING = {"perplexity": 30, "pca_components": 50}
+AUC = {
+    "svc": {
+        "kernel": "rbf",
+        "C": 30,
+        "probability": True,
+        "max_iter": 50 if args.DEBUG else -1,
+    },
+    "mlp": {
+        "hidden_layer_sizes": (1024, 1024),
+        "alpha": 0.001,
+        "max_iter": 50 if args.DEBUG else 2000,
+        "early_stopping": True,
+        "validation_fraction": 0.2,
+    },
+    "adaboost": {"n_estimators": 50 if args.DEBUG else 200},
+    "folds": 5,
+    "bootstraps": 100 if args.DEBUG else 500,
+}
+
 CONDITIONS = {
     "classic_cartpole": [
         (0.98, 0.5),
@@ -114,6 +157,48 @@ def plot_tsne(ax, zs, labels, title):
     ax.set_title(title)
 
 
+def compute_embedding(rep, method, seed):
+    perplexity = EMBEDDING["perplexity"]
+    components = EMBEDDING["pca_components"]
+    if method == "pca_tsne" and rep.shape[1] > components:
+        rep = PCA(n_components=components, random_state=seed).fit_transform(rep)
+    if method in ("tsne", "pca_tsne"):
+        return TSNE(
+            n_components=2, random_state=seed, perplexity=perplexity
+        ).fit_transform(rep)
+    if method == "opentsne":
+        from openTSNE import TSNE as OpenTSNE
+
+        tsne = OpenTSNE(
+            n_components=2,
+            perplexity=perplexity,
+            negative_gradient_method="fft",
+            random_state=seed,
+        )
+        return np.asarray(tsne.fit(rep))
+    if method == "umap":
+        import umap
+
+        return umap.UMAP(n_components=2, random_state=seed).fit_transform(rep)
+    raise ValueError(method)
+
+
+def embed_2d(rep):
+    params = {
+        "method": args.embedding,
+        "seed": args.MASTER_SEED,
+        "version": CACHE_VERSION,
+        **EMBEDDING,
+    }
+    return cached(
+        CACHE_DIR,
+        "embedding",
+        [rep],
+        params,
+        lambda: compute_embedding(rep, args.embedding, args.MASTER_SEED),
+    )
+
+
 def tsne_grid_analysis(df, env, modality, approach, output_dir):
     if env not in CONDITIONS:
         print(f"No conditions defined for {env}, skipping t-SNE analysis.")
@@ -182,14 +267,7 @@ def tsne_grid_analysis(df, env, modality, approach, output_dir):
                 ),
             ]
         )
-    zs_list = Parallel(n_jobs=-1)(
-        delayed(
-            lambda rep: TSNE(
-                n_components=2, random_state=args.MASTER_SEED, perplexity=30
-            ).fit_transform(rep)
-        )(rep)
-        for _, rep in combinations
-    )
+    zs_list = Parallel(n_jobs=-1)(delayed(embed_2d)(rep) for _, rep in combinations)
     zs_list = [(name, zs) for (name, _), zs in zip(combinations, zs_list)]
     n_cols = (len(combinations) + 1) // 2
     n_rows = 2
@@ -207,11 +285,13 @@ def tsne_grid_analysis(df, env, modality, approach, output_dir):
 
 def ablation_auc_analysis(data_path, env, modality, approach, output_dir):
     """Compute AUC for each context dimension and analyze significance with an ensemble."""
-    base_seed = args.MASTER_SEED + hash(f"{env}_{modality}_{approach}") % (2**32)
+    # crc32 instead of hash() which changes between processes, so the seeds and
+    # with them the cached scores are reproducible.
+    base_seed = args.MASTER_SEED + zlib.crc32(f"{env}_{modality}_{approach}".encode())
     np.random.seed(base_seed)
 
     try:
-        data = np.load(data_path, allow_pickle=True)
+        data = get_dataset_from_file(data_path)
     except Exception as e:
         print(f"Error loading {data_path}: {e}")
         return None
@@ -219,13 +299,23 @@ def ablation_auc_analysis(data_path, env, modality, approach, output_dir):
     n_trajs = 200 if args.DEBUG else 2000
 
     def compute_auc_for_dim(dim, data, base_seed):
-        """Compute AUC for a given context dimension using an ensemble with cross-validation."""
-        np.random.seed(base_seed + dim)
-
+        """Compute AUC for a given context dimension, cached by its trajectories."""
         # Select perturbed z dim trajectories
         key = f"z_dim{dim}"
-        original_trajs = data["original"][key][:n_trajs]
-        imagined_trajs = data["imagined"][key][:n_trajs]
+        original_trajs = np.asarray(data["original"][key][:n_trajs])
+        imagined_trajs = np.asarray(data["imagined"][key][:n_trajs])
+        params = {"dim": dim, "seed": base_seed, "version": CACHE_VERSION, **AUC}
+        return cached(
+            CACHE_DIR,
+            "auc",
+            [original_trajs, imagined_trajs],
+            params,
+            lambda: fit_auc_for_dim(dim, original_trajs, imagined_trajs, base_seed),
+        )
+
+    def fit_auc_for_dim(dim, original_trajs, imagined_trajs, base_seed):
+        """Compute AUC for a given context dimension using an ensemble with cross-validation."""
+        np.random.seed(base_seed + dim)
 
         X_seq = np.concatenate([original_trajs, imagined_trajs], axis=0)
         y = np.concatenate([np.zeros(len(original_trajs)), np.ones(len(imagined_trajs))])
@@ -235,37 +325,17 @@ def ablation_auc_analysis(data_path, env, modality, approach, output_dir):
 
         X_flat = X_seq.reshape(X_seq.shape[0], -1)
 
-        # Define number of estimators based on debug mode
-        if args.DEBUG:
-            ada_estimators = 50
-        else:
-            ada_estimators = 200
-
         # Define ensemble of strong classifiers from scikit-learn
         classifiers = [
-            SVC(
-                kernel='rbf',
-                C=30,
-                probability=True,
-                max_iter=50 if args.DEBUG else -1,
-                random_state=base_seed + dim
-            ),
-            MLPClassifier(
-                hidden_layer_sizes=(1024, 1024),
-                alpha=0.001,
-                max_iter=50 if args.DEBUG else 2000,
-                early_stopping=True,
-                validation_fraction=0.2,
-                random_state=base_seed + dim
-            ),
-            AdaBoostClassifier(
-                n_estimators=ada_estimators,
-                random_state=base_seed + dim
-            )
+            SVC(**AUC["svc"], random_state=base_seed + dim),
+            MLPClassifier(**AUC["mlp"], random_state=base_seed + dim),
+            AdaBoostClassifier(**AUC["adaboost"], random_state=base_seed + dim),
         ]
 
         # Cross-validation
-        skf = StratifiedKFold(n_splits=5, shuffle=True, random_state=base_seed + dim)
+        skf = StratifiedKFold(
+            n_splits=AUC["folds"], shuffle=True, random_state=base_seed + dim
+        )
         all_probs = []
         all_y = []
 
@@ -299,8 +369,7 @@ def ablation_auc_analysis(data_path, env, modality, approach, output_dir):
         # Bootstrap for confidence intervals
         bootstrap_aucs = []
         n_samples = len(all_y)
-        bootstrap_len = 100 if args.DEBUG else 500
-        for _ in range(bootstrap_len):
+        for _ in range(AUC["bootstraps"]):
             indices = np.random.choice(n_samples, n_samples, replace=True)
             sampled_probs = all_probs[indices]
             sampled_y = all_y[indices]
@@ -444,9 +513,12 @@ def main():
         print(f"Skipping unknown environment: {folder}")
         return
     print(f"\nProcessing {env_short} - {modality} - {approach}")
-    pickle_path = f"../logs_dali/{folder}/71/carl_{env}_ctx_represenations_windows.pkl"
+    pickle_path = f"../logs_dali/{folder}/71/carl_{env}_ctx_represenations_windows"
+    if not os.path.exists(pickle_path):
+        pickle_path += ".pkl"  # Recorded before the columnar store.
     try:
-        df = get_df_from_file(pickle_path)
+        keys = ["obs", "embed", "posterior", "prior", "action", "context_representation"]
+        df = get_df_from_file(pickle_path, keys=keys)
         X = np.stack(df["context_representation"].to_numpy())
         y = np.stack(df["real_context"].to_numpy())
         idx = np.random.choice(len(X), size=2000 if args.DEBUG else 10000, replace=False)
@@ -462,7 +534,9 @@ def main():
     for d in [auc_dir, tsne_dir, cf_dir]:
         os.makedirs(d, exist_ok=True)
 
-    trajectory_dataset_path = f"../logs_dali/{folder}/71/dataset_ep200_sigma.pkl"
+    trajectory_dataset_path = f"../logs_dali/{folder}/71/dataset_ep200_sigma"
+    if not os.path.exists(trajectory_dataset_path):
+        trajectory_dataset_path += ".pkl"  # Recorded before the columnar store.
     start_time = time.time()
     if os.path.exists(trajectory_dataset_path):
         print(f"Ablation data found at {trajectory_dataset_path}")
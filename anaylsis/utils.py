@@ -1,9 +1,32 @@
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import pickle
 import os
+import sys
 
-def get_df_from_file(filename):
+
+def latent_store():
+    """Imports the latent store module of the record scripts. Only stores need
+    it, so the plots can still load older pickles on their own."""
+    # contextual_mbrl is not installed, make the repository root importable.
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.append(root)
+    from contextual_mbrl.dreamer import latent_store
+
+    return latent_store
+
+
+def get_df_from_file(filename, keys=None, contexts=None):
+    """Loads recorded episodes into one row per sample. Stores written by the
+    record scripts only load the given keys and contexts (tuples of context
+    values in context_order), older pickles are always loaded in full."""
     print(f"Processing {filename}")
+    # Stores are directories, older recordings single pickle files.
+    if os.path.isdir(filename) and latent_store().is_store(filename):
+        return get_df_from_store(filename, keys, contexts)
     with open(filename, "rb") as f:
         data = pickle.load(f)
     rows = []
@@ -35,6 +58,87 @@ def get_df_from_file(filename):
 
     return pd.DataFrame(rows)
 
+def get_df_from_store(directory, keys=None, contexts=None):
+    store = latent_store()
+    records = store.read_index(directory)
+    context_tuples = [
+        tuple(r["context"][k] for k in r["context_order"]) for r in records
+    ]
+    if contexts is not None:
+        contexts = {tuple(c) for c in contexts}
+        selected = [i for i, c in enumerate(context_tuples) if c in contexts]
+        records = [records[i] for i in selected]
+        context_tuples = [context_tuples[i] for i in selected]
+    if not records:
+        return pd.DataFrame()
+    # Like get_df_from_file, keep the keys with one entry per observation.
+    lengths = [r["lengths"]["obs"] for r in records]
+    if keys is None:
+        keys = list(records[0]["lengths"])
+    keys = [
+        k for k in keys
+        if all(r["lengths"].get(k) == n for r, n in zip(records, lengths))
+    ]
+    columns = {}
+    for key in keys:
+        rows = np.concatenate(store.read_column(directory, key, records))
+        columns[key] = list(rows) if rows.ndim > 1 else rows
+    episodes, samples, real_context = [], [], []
+    counts = {}
+    for context, n in zip(context_tuples, lengths):
+        # Number the episodes within each context.
+        episode = counts.get(context, 0)
+        counts[context] = episode + 1
+        episodes.append(np.full(n, episode))
+        samples.append(np.arange(n))
+        real_context += [context] * n
+    columns["episode"] = np.concatenate(episodes)
+    columns["real_context"] = real_context
+    columns["sample"] = np.concatenate(samples)
+    return pd.DataFrame(columns)
+
+
+def get_dataset_from_file(filename):
+    """Loads a counterfactual dataset as {"original": {key: array}, "imagined":
+    {key: array}} from a store or an older pickle."""
+    if not (os.path.isdir(filename) and latent_store().is_store(filename)):
+        return np.load(filename, allow_pickle=True)
+    store = latent_store()
+    records = store.read_index(filename)
+    dataset = {}
+    for key in records[0]["lengths"]:
+        group, name = key.split("/", 1)
+        dataset.setdefault(group, {})[name] = np.concatenate(
+            store.read_column(filename, key, records)
+        )
+    return dataset
+
+
+def cached(cache_dir, name, arrays, params, compute):
+    """Returns compute() and stores it under a hash of the input arrays and
+    the parameters, so a later call with the same inputs loads the result.
+    Pass cache_dir=None to always compute."""
+    if cache_dir is None:
+        return compute()
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype}{array.shape}".encode())
+        digest.update(array.tobytes())
+    path = os.path.join(cache_dir, name, f"{digest.hexdigest()}.pkl")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    result = compute()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so parallel jobs never read partial files.
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "wb") as f:
+        pickle.dump(result, f)
+    os.replace(temp, path)
+    return result
+
+
 def create_folder(folder_path):
     # Check if folder exists, if not create it
     if not os.path.exists(folder_path):
@@ -0,0 +1,76 @@
+"""Builds agents once per config for the scripts that go through many logdirs.
+
+Runs that only differ in their logdir, seed or checkpoint build the same
+agent, so the scripts keep the agents and the jitted functions around them in
+one dict and only load the weights of each checkpoint into them. Evaluating
+or recording ten seeds of a scheme then compiles once instead of ten times.
+"""
+
+import json
+
+import dreamerv3
+import ruamel.yaml as yaml
+from dreamerv3 import embodied
+from dreamerv3 import ninjax as nj
+
+
+def config_key(config):
+    """Configs that only differ in these keys build the same agent."""
+    ignore = ("logdir", "seed", "run.from_checkpoint", "wandb.")
+    flat = {
+        k: v for k, v in config.flat.items() if not k.startswith(ignore)
+    }
+    return json.dumps(flat, sort_keys=True, default=str)
+
+
+def load_config(logdir, other, **defaults):
+    """Loads the config of a logdir, applies the defaults of the script and
+    then the command line overrides, and points it to the checkpoint."""
+    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
+    config = embodied.Config(config).update(defaults)
+    config = embodied.Flags(config).parse(other)
+    checkpoint = logdir / "checkpoint.ckpt"
+    assert checkpoint.exists(), checkpoint
+    return config.update({"run.from_checkpoint": str(checkpoint)})
+
+
+def load_step(checkpoint):
+    # Just load the step counter from the checkpoint, as there is
+    # a circular dependency to load the agent.
+    ckpt = embodied.Checkpoint()
+    ckpt.step = embodied.Counter()
+    ckpt.load(checkpoint, keys=["step"])
+    return ckpt._values["step"]
+
+
+def load_agent(agents, env, step, config):
+    """Returns the agent for the config, building it on first use. Callers
+    load the weights of their checkpoint into it."""
+    key = config_key(config)
+    if key not in agents:
+        agents[key] = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
+    return agents[key]
+
+
+def load_weights(agent, checkpoint):
+    loader = embodied.Checkpoint()
+    loader.agent = agent
+    loader.load(checkpoint, keys=["agent"])
+
+
+def load_policy(agents, env, step, config, checkpoint):
+    """Loads the eval policy of a checkpoint into the cached agent."""
+    agent = load_agent(agents, env, step, config)
+    load_weights(agent, checkpoint)
+    return lambda *args: agent.policy(*args, mode="eval")
+
+
+def load_dream_fn(agents, agent, config, wrap, *args):
+    """Returns the jitted pure function that wrap(agent.agent, *args) builds.
+    It takes the variables as input, so it is cached next to the agent and
+    traced once per config, wrapper and arguments."""
+    key = (config_key(config), wrap.__module__, wrap.__qualname__, args)
+    if key not in agents:
+        fn = nj.pure(wrap(agent.agent, *args))
+        agents[key] = nj.jit(fn, device=agent.train_devices[0])
+    return agents[key]
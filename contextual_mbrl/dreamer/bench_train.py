@@ -0,0 +1,228 @@
+"""Benchmarks the train step of the DALI configurations on dummy batches.
+
+For every scheme and crossmodal setting this reports the time to build the
+agent and compile the train step, the steady-state train steps per second,
+the peak device memory and the cost of the gradient of every world model
+loss term on its own. Results are appended as JSON lines to --out, and
+--baseline compares them against an earlier results file.
+
+  python -m contextual_mbrl.dreamer.bench_train --jax.platform cpu \\
+    --schemes enc_obs_dec_obs_ctxencoder_mlp enc_obs_dec_obs_ctxencoder_gru
+"""
+
+import json
+import sys
+import time
+import warnings
+
+import dreamerv3
+import jax
+import jax.numpy as jnp
+import numpy as np
+import ruamel.yaml as yaml
+from dreamerv3 import embodied
+from dreamerv3 import ninjax as nj
+
+warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+
+SCHEMES = [
+    "enc_obs_dec_obs",
+    "enc_obs_dec_obs_ctxencoder_mlp",
+    "enc_obs_dec_obs_ctxencoder_gru",
+    "enc_obs_dec_obs_ctxencoder_attention",
+    "enc_obs_dec_obs_ctxencoder_transformer",
+    "enc_img_dec_img_ctxencoder_transformer",
+]
+
+
+def make_spaces(parsed):
+    obs_space = {
+        "obs": embodied.Space(np.float32, (parsed.obs_dim,)),
+        "context": embodied.Space(np.float32, (parsed.ctx_dim,)),
+        "image": embodied.Space(np.uint8, (64, 64, 3)),
+        "reward": embodied.Space(np.float32),
+        "is_first": embodied.Space(bool),
+        "is_last": embodied.Space(bool),
+        "is_terminal": embodied.Space(bool),
+    }
+    act_space = {
+        "action": embodied.Space(np.float32, (parsed.act_dim,), -1, 1),
+        "reset": embodied.Space(bool),
+    }
+    return obs_space, act_space
+
+
+def make_batch(agent, obs_space, act_space, seed=0):
+    dims = (agent.batch_size, agent.batch_length)
+    data = agent._dummy_batch({**obs_space, **act_space}, dims)
+    # Random inputs instead of zeros so no branch of the model is trivial.
+    rng = np.random.default_rng(seed)
+    for key, value in data.items():
+        if value.dtype == np.float32:
+            data[key] = rng.normal(size=value.shape).astype(np.float32)
+        elif value.dtype == np.uint8:
+            data[key] = rng.integers(0, 255, value.shape, np.uint8)
+    data["is_first"][:, 0] = True
+    return agent._convert_inps(data, agent.train_devices)
+
+
+def timed(fn, steps):
+    start = time.perf_counter()
+    for _ in range(steps):
+        out = fn()
+    jax.block_until_ready(out)
+    return (time.perf_counter() - start) / steps
+
+
+def peak_memory(devices):
+    peaks = []
+    for device in devices:
+        stats = device.memory_stats() or {}
+        if "peak_bytes_in_use" in stats:
+            peaks.append(stats["peak_bytes_in_use"])
+    return max(peaks) if peaks else None
+
+
+def loss_term_costs(agent, data, parsed):
+    """Seconds for the gradient of every world model loss term on its own.
+    XLA prunes everything that the term does not depend on."""
+    wm = agent.agent.wm
+    modules = [wm.encoder, wm.rssm, *wm.heads.values()]
+
+    def term_grad(data, state, key=None):
+        data = agent.agent.preprocess(data)
+
+        def lossfn(data, state):
+            _, (_, outs, _) = wm.loss(data, state)
+            if key is None:
+                return {k[: -len("_loss")]: v for k, v in outs.items() if k.endswith("_loss")}
+            return outs[f"{key}_loss"].mean()
+
+        if key is None:
+            return lossfn(data, state)
+        loss, _, grads = nj.grad(lossfn, modules)(data, state)
+        # Return the gradient norm so the backward pass is not pruned.
+        return loss, sum(jnp.square(g.astype(jnp.float32)).sum() for g in grads.values())
+
+    device = agent.train_devices[0]
+    rng = agent._next_rngs(agent.train_devices)
+    state, _ = agent._init_train(agent.varibs, rng, data["is_first"])
+    pure = nj.pure(term_grad)
+    keys = jax.eval_shape(lambda: pure(agent.varibs, rng, data, state)[0]).keys()
+    fn = nj.jit(pure, static=["key"], device=device)
+    costs = {}
+    for key in sorted(keys):
+        call = lambda: fn(agent.varibs, rng, data, state, key=key)[0]
+        jax.block_until_ready(call())
+        costs[key] = timed(call, parsed.term_steps)
+    return costs
+
+
+def bench(name, crossmodal, master, other, parsed):
+    config = embodied.Config(master["defaults"])
+    config = config.update(master["carl"]).update(master[name])
+    config = config.update({"ctx_encoder.crossmodal": crossmodal})
+    config = embodied.Flags(config).parse(other)
+    obs_space, act_space = make_spaces(parsed)
+
+    start = time.perf_counter()
+    agent = dreamerv3.Agent(obs_space, act_space, embodied.Counter(), config)
+    init = time.perf_counter() - start
+    data = make_batch(agent, obs_space, act_space)
+    state = [None]
+
+    def step():
+        _, state[0], _ = agent.train(data, state[0])
+        return agent.varibs
+
+    start = time.perf_counter()
+    jax.block_until_ready(step())
+    compile_time = time.perf_counter() - start
+    timed(step, parsed.warmup)
+    step_time = timed(step, parsed.steps)
+
+    result = {
+        "scheme": name,
+        "crossmodal": crossmodal,
+        "platform": config.jax.platform,
+        "batch_size": config.batch_size,
+        "batch_length": config.batch_length,
+        "init_s": init,
+        "compile_s": compile_time,
+        "step_ms": 1000 * step_time,
+        "steps_per_sec": 1 / step_time,
+        "peak_memory": peak_memory(agent.train_devices),
+        "jax": jax.__version__,
+    }
+    if parsed.loss_terms:
+        costs = loss_term_costs(agent, data, parsed)
+        result["loss_terms_ms"] = {k: 1000 * v for k, v in costs.items()}
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Returns the lines for every metric that got slower than the baseline
+    by more than the tolerance."""
+    previous = {}
+    with open(baseline) as f:
+        for line in f:
+            row = json.loads(line)
+            previous[(row["scheme"], row["crossmodal"], row["platform"])] = row
+    regressions = []
+    for row in results:
+        old = previous.get((row["scheme"], row["crossmodal"], row["platform"]))
+        if not old:
+            continue
+        pairs = [("step_ms", old["step_ms"], row["step_ms"])]
+        for key, value in row.get("loss_terms_ms", {}).items():
+            if key in old.get("loss_terms_ms", {}):
+                pairs.append((f"{key}_loss", old["loss_terms_ms"][key], value))
+        for metric, before, after in pairs:
+            if after > before * (1 + tolerance):
+                regressions.append(
+                    f"{row['scheme']} crossmodal={row['crossmodal']} {metric}: "
+                    f"{before:.2f}ms -> {after:.2f}ms"
+                )
+    return regressions
+
+
+def main():
+    parsed, other = embodied.Flags(
+        schemes=SCHEMES,
+        crossmodal=[True, False],
+        steps=20,
+        warmup=3,
+        loss_terms=True,
+        term_steps=5,
+        obs_dim=24,
+        act_dim=6,
+        ctx_dim=2,
+        out="bench_train.jsonl",
+        baseline="",
+        tolerance=0.1,
+    ).parse_known()
+    master = yaml.YAML(typ="safe").load(
+        (embodied.Path(__file__).parent / "configs.yaml").read()
+    )
+
+    results = []
+    for name in parsed.schemes:
+        # The crossmodal setting only matters with a context encoder.
+        crossmodals = parsed.crossmodal if "ctxencoder" in name else parsed.crossmodal[:1]
+        for crossmodal in crossmodals:
+            result = bench(name, crossmodal, master, other, parsed)
+            print(json.dumps(result))
+            results.append(result)
+            with open(parsed.out, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    if parsed.baseline:
+        regressions = compare(results, parsed.baseline, parsed.tolerance)
+        for line in regressions:
+            print("Regression:", line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -301,13 +301,15 @@ def make_envs(config, **overrides):
             ctor = bind(embodied.wrappers.RestartOnException, ctor)
         ctors.append(ctor)
     envs = [ctor() for ctor in ctors]
-    return embodied.BatchEnv(envs, parallel=(config.envs.parallel != "none"))
+    parallel = config.envs.parallel != "none"
+    shared = parallel and getattr(config.envs, "shared", False)
+    return embodied.BatchEnv(envs, parallel=parallel, shared=shared)
 
 
-def make_env(config, **overrides):
+def make_env(config, index=None, **overrides):
     suite, task = config.task.split("_", 1)
     if suite == "carl":
-        return make_carl_env(config, **overrides)
+        return make_carl_env(config, index, **overrides)
     else:
         return dreamerv3.train.make_env(config, **overrides)
 
@@ -413,6 +415,26 @@ class RandomizedRoundRobinSelector(AbstractSelector):
         return context, self.context_id
 
 
+class SetContextWrapper(embodied.Wrapper):
+    """Switch the wrapped CARL env to a new context in place.
+
+    The context is applied right away and takes effect with the next reset.
+    """
+
+    def __init__(self, env, carl_env: CARLEnv):
+        super().__init__(env)
+        self._carl_env = carl_env
+
+    def set_context(self, context: Context) -> None:
+        carl_env = self._carl_env
+        carl_env.contexts = {0: context}
+        carl_env.context_selector.contexts = carl_env.contexts
+        # CARLEnv only updates the context when the selected id changes, and
+        # with a single context the id stays 0.
+        carl_env.context = carl_env.contexts[0]
+        carl_env._update_context()
+
+
 class ResizeImage(embodied.wrappers.ResizeImage):
     """Change interpolation to BILINEAR"""
 
@@ -423,7 +445,7 @@ class ResizeImage(embodied.wrappers.ResizeImage):
         return image
 
 
-def make_carl_env(config, **overrides):
+def make_carl_env(config, index=None, **overrides):
     suite, task = config.task.split("_", 1)
     assert suite == "carl", suite
 
@@ -475,10 +497,10 @@ def make_carl_env(config, **overrides):
     else:
         raise NotImplementedError(f"Context {config.env.carl.context} not implemented.")
 
-    return create_wrapped_carl_env(env_cls, contexts, config)
+    return create_wrapped_carl_env(env_cls, contexts, config, index)
 
 
-def gen_carl_val_envs(config, **overrides):
+def gen_carl_val_contexts(config):
     suite, task = config.task.split("_", 1)
     assert suite == "carl", suite
     env_cls: CARLEnv = _TASK2ENV[task]
@@ -547,28 +569,66 @@ def gen_carl_val_envs(config, **overrides):
                 continue
             contexts.append({"context": c, "changed": [ctx_0_name, ctx_1_name]})
 
-    for context_info in contexts:
-        ctors = []
-        for index in range(config.envs.amount):
-            ctor = lambda: create_wrapped_carl_env(
-                env_cls, contexts={0: context_info["context"]}, config=config
-            )
+    return contexts
+
+
+def make_carl_val_env(config, context):
+    suite, task = config.task.split("_", 1)
+    env_cls: CARLEnv = _TASK2ENV[task]
+    ctors = []
+    for index in range(config.envs.amount):
+        ctor = lambda: create_wrapped_carl_env(
+            env_cls, contexts={0: context}, config=config
+        )
+        if config.envs.parallel != "none":
+            ctor = bind(embodied.Parallel, ctor, config.envs.parallel)
+        if config.envs.restart:
+            ctor = bind(embodied.wrappers.RestartOnException, ctor)
+        ctors.append(ctor)
+    envs = [ctor() for ctor in ctors]
+    parallel = config.envs.parallel != "none"
+    shared = parallel and getattr(config.envs, "shared", False)
+    return embodied.BatchEnv(envs, parallel=parallel, shared=shared), envs
+
+
+def gen_carl_val_envs(config, **overrides):
+    for context_info in gen_carl_val_contexts(config):
+        env, _ = make_carl_val_env(config, context_info["context"])
+        yield env, context_info
+
+
+def gen_carl_val_env_pool(config, contexts=None):
+    """Like gen_carl_val_envs, but yields the same env for every context.
+
+    The workers are created once and switched to the next context in place,
+    so the sweep does not spawn processes and build envs per context. The env
+    is closed after the last context and must not be closed by the caller.
+    Pass a subset of gen_carl_val_contexts as contexts to only visit those.
+    """
+    if contexts is None:
+        contexts = gen_carl_val_contexts(config)
+    if not contexts:
+        return
+    env, envs = make_carl_val_env(config, contexts[0]["context"])
+    try:
+        for context_info in contexts:
+            promises = [e.set_context(context_info["context"]) for e in envs]
             if config.envs.parallel != "none":
-                ctor = bind(embodied.Parallel, ctor, config.envs.parallel)
-            if config.envs.restart:
-                ctor = bind(embodied.wrappers.RestartOnException, ctor)
-            ctors.append(ctor)
-        envs = [ctor() for ctor in ctors]
-        yield embodied.BatchEnv(
-            envs, parallel=(config.envs.parallel != "none")
-        ), context_info
+                [promise() for promise in promises]
+            yield env, context_info
+    finally:
+        env.close()
 
 
-def create_wrapped_carl_env(env_cls: CARLEnv, contexts, config):
+def create_wrapped_carl_env(env_cls: CARLEnv, contexts, config, index=None):
     _, task = config.task.split("_", 1)
     # Only the context features that might change in training or evaluation are # added to the observation space
     context_features = [o["context"] for o in _TASK2CONTEXTS[task]]
-    seed = int(current_process().name.split("-")[-1]) + int(config.seed)
+    # The index of the env offsets its seed. Without one, the env runs in an
+    # embodied.Parallel worker and uses the number of its Process-<n> name.
+    if index is None:
+        index = int(current_process().name.split("-")[-1])
+    seed = index + int(config.seed)
     if task == "box2d_lunar_lander":
         env_cls = bind(
             env_cls,
@@ -588,16 +648,26 @@ def create_wrapped_carl_env(env_cls: CARLEnv, contexts, config):
     # reset once for paranoia
     env.reset(seed=seed)
 
+    # Render DMC and pendulum frames directly at the image size, which skips
+    # the resize. The other envs draw fixed pixel sizes and are still resized.
+    size = (64, 64)
+    direct = getattr(config.env.carl, "render", "resize") == "direct"
     if "dmc" in task:
         env.env.render_mode = "rgb_array"
+        if direct:
+            env.render_size = size
     if task == "classic_cartpole":
         env.env.screen_width = 128
         env.env.screen_height = 128
+    if task == "classic_pendulum" and direct:
+        env.env.unwrapped.screen_dim = size[0]
+    carl_env = env
     env = NormalizeContextWrapper(env)
     if "classic" in task:
         env = TimeLimit(env, max_episode_steps=500)
 
     env = from_gymnasium.FromGymnasium(env, obs_key="obs")
     env = embodied.core.wrappers.RenderImage(env, key="image")
-    env = ResizeImage(env)
-    return dreamerv3.wrap_env(env, config)
+    if env.obs_space["image"].shape[:2] != size:
+        env = ResizeImage(env, size)
+    return SetContextWrapper(dreamerv3.wrap_env(env, config), carl_env)
@@ -1,17 +1,27 @@
 import sys
+import collections
 import csv
+import hashlib
+import json
 import logging
 import os
 import re
 import warnings
 
-import dreamerv3
 import jsonlines
 import numpy as np
-import ruamel.yaml as yaml
 from dreamerv3 import embodied
 
-from contextual_mbrl.dreamer.envs import gen_carl_val_envs
+from contextual_mbrl.dreamer.agent_cache import (
+    load_config,
+    load_policy,
+    load_step,
+)
+from contextual_mbrl.dreamer.envs import (
+    gen_carl_val_contexts,
+    gen_carl_val_env_pool,
+    make_carl_val_env,
+)
 
 logging.captureWarnings(True)
 if sys.platform == "linux":
@@ -38,6 +48,85 @@ def eval(policy, env, args, episodes=10):
 
     print("Start evaluation loop.")
     driver(policy, episodes=episodes)
+    return summarize(lengths, rewards)
+
+
+def eval_batched(make_policy, config, contexts=None, episodes=10):
+    """Evaluate all validation contexts together on one large batch of envs.
+
+    Every env runs one (context, episode) pair at a time and takes the next
+    pending pair when its episode ends, so the policy always steps the whole
+    batch. Returns the metrics of every context in the order of contexts,
+    which defaults to all of gen_carl_val_contexts.
+    """
+    if contexts is None:
+        contexts = gen_carl_val_contexts(config)
+    jobs = collections.deque(
+        index for _ in range(episodes) for index in range(len(contexts))
+    )
+    lengths = [[] for _ in contexts]
+    rewards = [[] for _ in contexts]
+    env, envs = make_carl_val_env(config, contexts[0]["context"])
+    current = [None] * len(envs)
+    switched = np.zeros(len(envs), bool)
+
+    def assign(worker):
+        index = jobs.popleft() if jobs else None
+        if index is not None and index != current[worker]:
+            switched[worker] = True
+            return index, envs[worker].set_context(contexts[index]["context"])
+        return index, None
+
+    promises = []
+    for worker in range(len(envs)):
+        current[worker], promise = assign(worker)
+        promises.append(promise)
+    [promise() for promise in promises if promise]
+    promises.clear()
+    policy = make_policy(env)
+
+    def per_episode(ep, worker):
+        index = current[worker]
+        if index is None:
+            return
+        lengths[index].append(len(ep["reward"]) - 1)
+        rewards[index].append(float(ep["reward"].astype(np.float64).sum()))
+        # The env resets with the new context on the next step.
+        current[worker], promise = assign(worker)
+        promises.append(promise)
+
+    def batched_policy(obs, state):
+        # Envs that moved on to another context start from a fresh policy
+        # state instead of carrying over the context window of the last one.
+        mask = switched.copy()
+        switched[:] = False
+        if state is not None and mask.any():
+            expand = lambda x: mask.reshape(mask.shape + (1,) * (x.ndim - 1))
+            state = embodied.treemap(lambda x: np.where(expand(x), 0, x), state)
+        return policy(obs, state)
+
+    driver = embodied.Driver(env)
+    driver.on_episode(per_episode)
+    print(f"Start batched evaluation loop on {len(envs)} envs.")
+    while any(index is not None for index in current):
+        # Resolve the context switches of the last steps, process workers
+        # keep every result until it is fetched.
+        [promise() for promise in promises if promise]
+        promises.clear()
+        driver(batched_policy, steps=len(envs))
+    env.close()
+    return [summarize(l, r) for l, r in zip(lengths, rewards)]
+
+
+def gen_eval_sequential(make_policy, config, args, contexts=None, episodes=50):
+    policy = None
+    for env, ctx_info in gen_carl_val_env_pool(config, contexts):
+        if policy is None:
+            policy = make_policy(env)
+        yield eval(policy, env, args, episodes=episodes), ctx_info
+
+
+def summarize(lengths, rewards):
     metrics = {
         "length": np.mean(lengths).astype(float),
         "length_std": np.std(lengths).astype(float),
@@ -54,6 +143,40 @@ def eval(policy, env, args, episodes=10):
     return metrics
 
 
+def checkpoint_hash(path, chunk=1 << 20):
+    digest = hashlib.sha256()
+    with embodied.Path(path).open("rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def eval_key(step, ckpt_hash, ctx_info, episodes, policy):
+    """Identifies one evaluation result, so a rerun can skip it."""
+    key = {
+        "checkpoint_step": int(step),
+        "checkpoint_hash": ckpt_hash,
+        "ctx": {**ctx_info},
+        "episodes": int(episodes),
+        "policy": policy,
+    }
+    # Round trip through JSON so the key matches the one read back from disk.
+    return json.dumps(key, sort_keys=True)
+
+
+def load_eval_keys(log_file):
+    """Keys of the results already in log_file. Rows from before the keys were
+    recorded have none and are never treated as done."""
+    if not log_file.exists():
+        return set()
+    keys = set()
+    with jsonlines.open(log_file) as reader:
+        for row in reader:
+            if "key" in row:
+                keys.add(json.dumps(row["key"], sort_keys=True))
+    return keys
+
+
 def create_random_policy(act_space):
     def policy(*args):
         bs = args[0]["is_first"].shape[0]
@@ -64,70 +187,85 @@ def create_random_policy(act_space):
     return policy
 
 
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-
-    # create argparse with logdir
-    parsed, other = embodied.Flags(logdir="", random_policy=False).parse_known()
-    logdir = embodied.Path(parsed.logdir)
+def eval_logdir(logdir, parsed, other, agents):
     is_random_policy = parsed.random_policy
-    # load the config from the logdir
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config = embodied.Config(config)
-    # parse the overrides for eval
-    config = embodied.Flags(config).parse(other)
-
+    config = load_config(logdir, other)
     checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Just load the step counter from the checkpoint, as there is
-    # a circular dependency to load the agent.
     step = 0
     if not is_random_policy:
-        ckpt = embodied.Checkpoint()
-        ckpt.step = embodied.Counter()
-        ckpt.load(checkpoint, keys=["step"])
-        step = ckpt._values["step"]
+        step = load_step(checkpoint)
 
-    policy = None
-    returns = []
-    lengths = []
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
         batch_steps=config.batch_size * config.batch_length,
     )
-    for env, ctx_info in gen_carl_val_envs(config):
 
-        if policy is None:
-            if is_random_policy:
-                policy = create_random_policy(env.act_space)
-            else:
-                agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-                checkpoint = embodied.Checkpoint()
-                checkpoint.agent = agent
-                checkpoint.load(args.from_checkpoint, keys=["agent"])
-                policy = lambda *args: agent.policy(*args, mode="eval")
-        metrics = eval(policy, env, args, episodes=50)
-        env.close()
-        returns.extend(metrics["returns"])
-        lengths.extend(metrics["lengths"])
+    # Write metrics to eval.jsonl
+    log_file = logdir / "eval.jsonl"
+    if is_random_policy:
+        log_file = logdir / "eval_random_policy.jsonl"
+
+    # Skip the contexts that an earlier run already evaluated for this exact
+    # checkpoint, so an interrupted sweep only computes what is missing.
+    episodes = 50
+    ckpt_hash = checkpoint_hash(checkpoint)
+    policy_name = "random" if is_random_policy else "agent"
+    keys = lambda ctx_info: eval_key(
+        step, ckpt_hash, ctx_info, episodes, policy_name
+    )
+    done = load_eval_keys(log_file)
+    all_contexts = gen_carl_val_contexts(config)
+    contexts = [c for c in all_contexts if keys(c) not in done]
+    skipped = len(all_contexts) - len(contexts)
+    print(f"Evaluating {len(contexts)} contexts, skipping {skipped} done.")
+    if not contexts:
+        return
+
+    def make_policy(env):
+        if is_random_policy:
+            return create_random_policy(env.act_space)
+        return load_policy(agents, env, step, config, args.from_checkpoint)
+
+    if parsed.batched:
+        config = config.update({"envs.amount": parsed.batched})
+        results = zip(
+            eval_batched(make_policy, config, contexts, episodes=episodes),
+            contexts,
+        )
+    else:
+        results = gen_eval_sequential(
+            make_policy, config, args, contexts, episodes=episodes
+        )
+
+    for metrics, ctx_info in results:
         metrics["ctx"] = {**ctx_info}
         metrics["aggregated_context_metric"] = False
         metrics["checkpoint_step"] = int(step)
-
-        # Write metrics to eval.jsonl
-        log_file = logdir / "eval.jsonl"
-        if is_random_policy:
-            log_file = logdir / "eval_random_policy.jsonl"
+        metrics["key"] = json.loads(keys(ctx_info))
 
         with jsonlines.open(log_file, mode="a") as writer:
             writer.write(metrics)
 
 
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+
+    # create argparse with logdir
+    # logdir: one or more logdirs, runs with the same config share one agent
+    # and are only compiled once
+    # batched: number of envs to evaluate all contexts at once, 0 to go
+    # through the contexts one after another
+    parsed, other = embodied.Flags(
+        logdir=[""], random_policy=False, batched=0
+    ).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Evaluating {logdir}")
+        eval_logdir(embodied.Path(logdir), parsed, other, agents)
+
 if __name__ == "__main__":
     main()
@@ -4,32 +4,34 @@ import logging
 import os
 import re
 import warnings
-import pickle
 
-import dreamerv3
 import jsonlines
 import numpy as np
-import ruamel.yaml as yaml
 from dreamerv3 import embodied
 
-from contextual_mbrl.dreamer.envs import gen_carl_val_envs
+from contextual_mbrl.dreamer.agent_cache import (
+    load_config,
+    load_policy,
+    load_step,
+)
+from contextual_mbrl.dreamer.envs import gen_carl_val_env_pool
+from contextual_mbrl.dreamer.latent_store import LatentWriter
 
 logging.captureWarnings(True)
 if sys.platform == "linux":
     os.environ["MUJOCO_GL"] = "egl"  # use EGL instead of GLFW to render MuJoCo
 
 
-def eval(policy, env, args, episodes=10):
-    report = []
+def eval(policy, env, args, store, info, episodes=10):
     lengths = []
     rewards = []
 
     def per_episode(ep):
-        report.append({
+        store.add({
             "obs": ep["obs"],
             "action": ep["action"],
             "context": ep["context"]
-        })
+        }, **info)
         length = len(ep["reward"]) - 1
         score = float(ep["reward"].astype(np.float64).sum())
         print(f"Episode has {length} steps and return {score:.1f}.")
@@ -58,7 +60,7 @@ def eval(policy, env, args, episodes=10):
         "lengths": lengths,
     }
 
-    return metrics, report
+    return metrics
 
 
 def create_random_policy(act_space):
@@ -71,39 +73,16 @@ def create_random_policy(act_space):
     return policy
 
 
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-
-    # create argparse with logdir
-    parsed, other = embodied.Flags(logdir="", random_policy=False).parse_known()
-    logdir = embodied.Path(parsed.logdir)
+def record_logdir(logdir, parsed, other, agents):
     is_random_policy = parsed.random_policy
-    # load the config from the logdir
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config = embodied.Config(config)
-    # parse the overrides for eval
-    config = embodied.Flags(config).parse(other)
-
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Just load the step counter from the checkpoint, as there is
-    # a circular dependency to load the agent.
+    config = load_config(logdir, other)
     step = 0
     if not is_random_policy:
-        ckpt = embodied.Checkpoint()
-        ckpt.step = embodied.Counter()
-        ckpt.load(checkpoint, keys=["step"])
-        step = ckpt._values["step"]
+        step = load_step(logdir / "checkpoint.ckpt")
 
     policy = None
     returns = []
     lengths = []
-    ctx2latent = []
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
@@ -116,29 +95,25 @@ def main():
     ctx_0 = _TASK2CONTEXTS[task][0]["context"]
     ctx_1 = _TASK2CONTEXTS[task][1]["context"]
 
-    for env, ctx_info in gen_carl_val_envs(config):
+    # Episodes are streamed to disk, see latent_store.py for the format.
+    store = LatentWriter(logdir / f"{suite}_{task}_random_policy_data")
+    for env, ctx_info in gen_carl_val_env_pool(config):
 
         if policy is None:
             if is_random_policy:
                 policy = create_random_policy(env.act_space)
             else:
-                agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-                checkpoint = embodied.Checkpoint()
-                checkpoint.agent = agent
-                checkpoint.load(args.from_checkpoint, keys=["agent"])
-                policy = lambda *args: agent.policy(*args, mode="eval")
-        metrics, logs = eval(policy, env, args, episodes=50)
-        ctx2latent.append(
-            {
-                "context": {
-                    ctx_0: ctx_info["context"][ctx_0],
-                    ctx_1: ctx_info["context"][ctx_1],
-                },
-                "context_order": [ctx_0, ctx_1],
-                "episodes": logs,
-            }
-        )
-        env.close()
+                policy = load_policy(
+                    agents, env, step, config, args.from_checkpoint
+                )
+        info = {
+            "context": {
+                ctx_0: ctx_info["context"][ctx_0],
+                ctx_1: ctx_info["context"][ctx_1],
+            },
+            "context_order": [ctx_0, ctx_1],
+        }
+        metrics = eval(policy, env, args, store, info, episodes=50)
         returns.extend(metrics["returns"])
         lengths.extend(metrics["lengths"])
         metrics["ctx"] = {**ctx_info}
@@ -153,8 +128,24 @@ def main():
         with jsonlines.open(log_file, mode="a") as writer:
             writer.write(metrics)
 
-    with (logdir / f"{suite}_{task}_random_policy_data.pkl").open("wb") as f:
-        pickle.dump(ctx2latent, f)
+    store.close()
+
+
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+
+    # create argparse with logdir
+    # logdir: one or more logdirs, runs with the same config share one agent
+    parsed, other = embodied.Flags(
+        logdir=[""], random_policy=False
+    ).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+"""Chunked columnar store for the episodes written by the record scripts.
+
+A store is a directory with this layout:
+
+    episodes.jsonl      one line per episode with its info (e.g. context and
+                        context_order), its shard and the row offset and
+                        length of every key within that shard
+    <key>/<shard>.npy   the rows of one key for all episodes of a shard,
+                        concatenated along the first axis
+
+Episodes are buffered until a shard is full and the index only references
+shards that are completely written, so recording uses bounded memory and an
+interrupted recording leaves a readable store of the finished episodes.
+Readers memory-map the shards and only touch the keys they ask for. A new
+writer replaces an existing store, so rerunning a record script does not
+duplicate its episodes, unless it is opened with append=True.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+INDEX = "episodes.jsonl"
+
+
+class LatentWriter:
+    def __init__(self, directory, chunk_bytes=64 << 20, append=False):
+        """Replaces an existing store at directory, like writing a new pickle
+        would, unless append is set."""
+        self._directory = str(directory)
+        self._chunk_bytes = chunk_bytes
+        if not append:
+            clear(self._directory)
+        os.makedirs(self._directory, exist_ok=True)
+        # Append to an existing store after its last complete shard.
+        shards = [record["shard"] for record in read_index(self._directory)]
+        self._shard = max(shards) + 1 if shards else 0
+        self._columns = {}
+        self._rows = {}
+        self._pending = []
+        self._bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, episode, **info):
+        """Add one episode, a dict of arrays that share the episode along
+        their first axis. The info is stored in the index and must be JSON
+        serializable."""
+        offsets, lengths = {}, {}
+        for key, value in episode.items():
+            value = np.asarray(value)
+            offsets[key] = self._rows.get(key, 0)
+            lengths[key] = len(value)
+            self._columns.setdefault(key, []).append(value)
+            self._rows[key] = offsets[key] + len(value)
+            self._bytes += value.nbytes
+        self._pending.append(
+            {**info, "shard": self._shard, "offsets": offsets, "lengths": lengths}
+        )
+        if self._bytes >= self._chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        for key, values in self._columns.items():
+            folder = os.path.join(self._directory, key)
+            os.makedirs(folder, exist_ok=True)
+            np.save(
+                os.path.join(folder, f"{self._shard:05}.npy"), np.concatenate(values)
+            )
+        with open(os.path.join(self._directory, INDEX), "a") as f:
+            for record in self._pending:
+                f.write(json.dumps(record, default=_to_json) + "\n")
+        self._columns, self._rows, self._pending = {}, {}, []
+        self._bytes = 0
+        self._shard += 1
+
+    def close(self):
+        self.flush()
+
+
+def clear(directory):
+    """Deletes the index and the shards of the store at directory."""
+    directory = str(directory)
+    if not is_store(directory):
+        return  # Shards without an index are overwritten from shard 0 on.
+    # Also the folders of shards that were written after the last index line.
+    folders = [
+        name
+        for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))
+    ]
+    os.remove(os.path.join(directory, INDEX))
+    for name in folders:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(str(path), INDEX))
+
+
+def read_index(directory):
+    """Returns the index records of all episodes in the store."""
+    path = os.path.join(str(directory), INDEX)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_column(directory, key, records=None):
+    """Returns the rows of key for every record as memory-mapped arrays.
+    Records default to all episodes of the store and can be filtered
+    beforehand, e.g. by their context."""
+    if records is None:
+        records = read_index(directory)
+    shards = {}
+    rows = []
+    for record in records:
+        shard = record["shard"]
+        if shard not in shards:
+            path = os.path.join(str(directory), key, f"{shard:05}.npy")
+            shards[shard] = np.load(path, mmap_mode="r")
+        start = record["offsets"][key]
+        rows.append(shards[shard][start : start + record["lengths"][key]])
+    return rows
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"Cannot store {type(value)} in the index.")
@@ -1,20 +1,24 @@
 import logging
 import os, sys
-import pickle
 import warnings
 
-import dreamerv3
 import jax
 import jax.numpy as jnp
 import numpy as np
-import ruamel.yaml as yaml
 from dreamerv3 import embodied
-from dreamerv3 import ninjax as nj
 
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+    load_weights,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
 )
-from contextual_mbrl.dreamer.envs import gen_carl_val_envs
+from contextual_mbrl.dreamer.envs import gen_carl_val_env_pool
+from contextual_mbrl.dreamer.latent_store import LatentWriter
 
 logging.captureWarnings(True)
 if sys.platform == "linux":
@@ -29,7 +33,14 @@ def _wrap_dream_agent(agent):
         ctx = None
         embed = wm.encoder(data)
 
-        if wm.use_ctx_encoder:
+        if wm.use_ctx_encoder and wm.ctx_encoder.causal:
+            # A causal encoder yields every step's context in one pass; limit
+            # its lookback to the training window like the sliding windows below.
+            ctx = wm.ctx_encoder(
+                {"obs": data["obs"], "action": data["action"], "embed": embed},
+                window=int(agent.config["batch_length"]),
+            )
+        elif wm.use_ctx_encoder:
             # Extract dimensions for clarity
             batch_size = int(data["obs"].shape[0])
             num_steps = int(data["obs"].shape[1])
@@ -188,11 +199,9 @@ def _wrap_dream_agent(agent):
     return gen_dream
 
 
-def collect_ctx_representations(agent, env, args, dream_agent_fn, episodes):
-    report = []
-
+def collect_ctx_representations(agent, env, args, dream_agent_fn, episodes, store, info):
     def per_episode(ep):
-        nonlocal agent, report
+        nonlocal agent
         # Stack episode data into a batch.
         batch = {k: np.stack([v], 0) for k, v in ep.items()}
         jax_batch = agent._convert_inps(batch, agent.train_devices)
@@ -200,85 +209,69 @@ def collect_ctx_representations(agent, env, args, dream_agent_fn, episodes):
         r, _ = dream_agent_fn(agent.varibs, rng, jax_batch)
         if r:
             r = agent._convert_mets(r, agent.train_devices)
-            report.append(r)
+            store.add(r, **info)
 
     driver = embodied.Driver(env)
     driver.on_episode(lambda ep, worker: per_episode(ep))
 
-    checkpoint = embodied.Checkpoint()
-    checkpoint.agent = agent
-    checkpoint.load(args.from_checkpoint, keys=["agent"])
-
     policy = lambda *args: agent.policy(*args, mode="eval")
     driver(policy, episodes=episodes)
 
-    return report
-
-
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-
-    # Create argparse with logdir and episodes.
-    parsed, other = embodied.Flags(logdir="", episodes=1).parse_known()
-    logdir = embodied.Path(parsed.logdir)
 
-    # Load the config from the logdir.
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config["envs"]["amount"] = 2
-    config = embodied.Config(config)
-    # Parse any command-line overrides for evaluation.
-    config = embodied.Flags(config).parse(other)
-
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Load only the step counter from the checkpoint to avoid circular dependencies.
-    ckpt = embodied.Checkpoint()
-    ckpt.step = embodied.Counter()
-    ckpt.load(checkpoint, keys=["step"])
-    step = ckpt._values["step"]
+def record_logdir(logdir, parsed, other, agents):
+    config = load_config(logdir, other, envs={"amount": 2})
+    step = load_step(logdir / "checkpoint.ckpt")
 
     dream_agent_fn = None
     agent = None
-    ctx2latent = []
     suite, task = config.task.split("_", 1)
     ctx_0 = _TASK2CONTEXTS[task][0]["context"]
     ctx_1 = _TASK2CONTEXTS[task][1]["context"]
 
-    for env, ctx_info in gen_carl_val_envs(config):
+    # Episodes are streamed to disk, see latent_store.py for the format.
+    store = LatentWriter(logdir / f"{suite}_{task}_ctx_represenations_windows")
+    for env, ctx_info in gen_carl_val_env_pool(config):
         if agent is None:
-            agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-            dream_agent_fn = nj.pure(_wrap_dream_agent(agent.agent))
-            dream_agent_fn = nj.jit(dream_agent_fn, device=agent.train_devices[0])
+            agent = load_agent(agents, env, step, config)
+            dream_agent_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent)
+            # Once per logdir, the contexts below all use these weights.
+            load_weights(agent, config.run.from_checkpoint)
         args = embodied.Config(
             **config.run,
             logdir=config.logdir,
             batch_steps=config.batch_size * config.batch_length,
         )
-        logs = collect_ctx_representations(
+        info = {
+            "context": {
+                ctx_0: ctx_info["context"][ctx_0],
+                ctx_1: ctx_info["context"][ctx_1],
+            },
+            "context_order": [ctx_0, ctx_1],
+        }
+        collect_ctx_representations(
             agent,
             env,
             args,
             dream_agent_fn,
             parsed.episodes,
+            store,
+            info,
         )
-        ctx2latent.append(
-            {
-                "context": {
-                    ctx_0: ctx_info["context"][ctx_0],
-                    ctx_1: ctx_info["context"][ctx_1],
-                },
-                "context_order": [ctx_0, ctx_1],
-                "episodes": logs,
-            }
-        )
-        env.close()
+    store.close()
+
+
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
 
-    with (logdir / f"{suite}_{task}_ctx_represenations_windows.pkl").open("wb") as f:
-        pickle.dump(ctx2latent, f)
+    # Create argparse with one or more logdirs and episodes, runs with the
+    # same config share one agent.
+    parsed, other = embodied.Flags(logdir=[""], episodes=1).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
 
 
 if __name__ == "__main__":
@@ -5,15 +5,18 @@ import warnings
 from functools import partial
 
 import cv2
-import dreamerv3
 import jax.numpy as jnp
 import numpy as np
-import ruamel.yaml as yaml
 from carl.envs.carl_env import CARLEnv
 from dreamerv3 import embodied, jaxutils
-from dreamerv3 import ninjax as nj
 from dreamerv3.embodied.core.logger import _encode_gif
 
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
     _TASK2ENV,
@@ -62,7 +65,7 @@ def _wrap_dream_agent(agent):
                 )
                 if "embed" in agent.config.ctx_encoder.inputs:
                     data["embed"] = embed
-                ctx = wm.ctx_encoder({**data})
+                ctx = wm.ctx_encoder({**data}, window=agent.config.batch_length)
                 seq_len = 10
                 # apply pertubation
                 ctx = ctx.at[0, :, dim].set(ctx[0, :, dim] + pertubation)
@@ -215,40 +218,14 @@ def record_dream(agent, env, args, ctx_info, logdir, dream_agent_fn, ctx_id, tas
     driver(policy, episodes=1)
 
 
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-
-    parsed, other = embodied.Flags(logdir="", episodes=1, ctx_id=1).parse_known()
-    logdir = embodied.Path(parsed.logdir)
+def record_logdir(logdir, parsed, other, agents):
     ctx_id = parsed.ctx_id
-    logdir = embodied.Path(parsed.logdir)
-    # load the config from the logdir
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config["envs"]["amount"] = 1
-    config = embodied.Config(config)
-    config = embodied.Flags(config).parse(other)
-
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Just load the step counter from the checkpoint, as there is
-    # a circular dependency to load the agent.
-    ckpt = embodied.Checkpoint()
-    ckpt.step = embodied.Counter()
-    ckpt.load(checkpoint, keys=["step"])
-    step = ckpt._values["step"]
+    config = load_config(logdir, other, envs={"amount": 1})
+    step = load_step(logdir / "checkpoint.ckpt")
     suite, task = config.task.split("_", 1)
-    dream_agent_fn = None
-    agent = None
     env, ctx_info = generate_envs(config, ctx_id)
-    if agent is None:
-        agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-        dream_agent_fn = nj.pure(_wrap_dream_agent(agent.agent))
-        dream_agent_fn = nj.jit(dream_agent_fn, device=agent.train_devices[0])
+    agent = load_agent(agents, env, step, config)
+    dream_agent_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent)
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
@@ -268,5 +245,19 @@ def main():
     env.close()
 
 
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+
+    # logdir: one or more logdirs, runs with the same config share one agent
+    parsed, other = embodied.Flags(logdir=[""], episodes=1, ctx_id=1).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
+
+
 if __name__ == "__main__":
     main()
@@ -5,11 +5,9 @@ import warnings
 from functools import partial
 
 import cv2
-import dreamerv3
 import jax
 import jax.numpy as jnp
 import numpy as np
-import ruamel.yaml as yaml
 from carl.envs.carl_env import CARLEnv
 from dreamerv3 import embodied, jaxutils
 from dreamerv3 import ninjax as nj
@@ -19,6 +17,12 @@ import numpy as np
 import cv2
 import imageio
 
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
     _TASK2ENV,
@@ -155,34 +159,15 @@ def record_dream(agent, env, args, ctx_info, logdir, dream_agent_fn, ctx_id, z_d
     driver(policy, episodes=1)
 
 
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-    parsed, other = embodied.Flags(logdir="", episodes=1, ctx_id=0, z_dim=3).parse_known()
-    logdir = embodied.Path(parsed.logdir)
+def record_logdir(logdir, parsed, other, agents):
     ctx_id = parsed.ctx_id
     z_dim = parsed.z_dim
-    logdir = embodied.Path(parsed.logdir)
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config["envs"]["amount"] = 1
-    config = embodied.Config(config)
-    config = embodied.Flags(config).parse(other)
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-    ckpt = embodied.Checkpoint()
-    ckpt.step = embodied.Counter()
-    ckpt.load(checkpoint, keys=["step"])
-    step = ckpt._values["step"]
+    config = load_config(logdir, other, envs={"amount": 1})
+    step = load_step(logdir / "checkpoint.ckpt")
     suite, task = config.task.split("_", 1)
-    dream_agent_fn = None
-    agent = None
     env, ctx_info = generate_envs(config, ctx_id)
-    if agent is None:
-        agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-        dream_agent_fn = nj.pure(_wrap_dream_agent(agent.agent, z_dim))
-        dream_agent_fn = nj.jit(dream_agent_fn, device=agent.train_devices[0])
+    agent = load_agent(agents, env, step, config)
+    dream_agent_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent, z_dim)
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
@@ -202,5 +187,17 @@ def main():
     env.close()
 
 
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+    # logdir: one or more logdirs, runs with the same config share one agent
+    parsed, other = embodied.Flags(logdir=[""], episodes=1, ctx_id=0, z_dim=3).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
+
+
 if __name__ == "__main__":
     main()
@@ -5,10 +5,8 @@ import warnings
 from functools import partial
 import matplotlib.pyplot as plt
 
-import dreamerv3
 import jax.numpy as jnp
 import numpy as np
-import ruamel.yaml as yaml
 from carl.envs.carl_env import CARLEnv
 from dreamerv3 import embodied
 from dreamerv3 import ninjax as nj
@@ -16,6 +14,12 @@ import jax
 from dreamerv3.nets import Linear
 from dreamerv3 import jaxutils
 
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
     _TASK2ENV,
@@ -177,29 +181,14 @@ def record_dream(agent, env, args, ctx_info, logdir, dream_fn, ctx_id, z_dim):
     driver(lambda *a: agent.policy(*a, mode="eval"), episodes=1)
 
 
-def main():
-    warnings.filterwarnings("ignore")
-    parsed, other = embodied.Flags(logdir="", episodes=1, ctx_id=0, z_dim=0).parse_known()
-    logdir = embodied.Path(parsed.logdir)
+def record_logdir(logdir, parsed, other, agents):
     ctx_id, z_dim = parsed.ctx_id, parsed.z_dim
-
-    cfg = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    cfg["envs"]["amount"] = 1
-    config = embodied.Config(cfg)
-    config = embodied.Flags(config).parse(other)
-
-    ckpt = logdir / "checkpoint.ckpt"
-    assert ckpt.exists()
-    config = config.update({"run.from_checkpoint": str(ckpt)})
-
-    c = embodied.Checkpoint()
-    c.step = embodied.Counter()
-    c.load(str(ckpt), keys=["step"])
-    step = c._values["step"]
+    config = load_config(logdir, other, envs={"amount": 1})
+    step = load_step(str(logdir / "checkpoint.ckpt"))
 
     env, ctx_info = generate_envs(config, ctx_id)
-    agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-    dream_fn = nj.jit(nj.pure(_wrap_dream_agent(agent.agent, z_dim)), device=agent.train_devices[0])
+    agent = load_agent(agents, env, step, config)
+    dream_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent, z_dim)
     args = embodied.Config(
         **config.run, logdir=config.logdir, batch_steps=config.batch_size * config.batch_length
     )
@@ -207,5 +196,15 @@ def main():
     env.close()
 
 
+def main():
+    warnings.filterwarnings("ignore")
+    # logdir: one or more logdirs, runs with the same config share one agent
+    parsed, other = embodied.Flags(logdir=[""], episodes=1, ctx_id=0, z_dim=0).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
+
+
 if __name__ == "__main__":
     main()
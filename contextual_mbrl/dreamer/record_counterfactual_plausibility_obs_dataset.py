@@ -4,20 +4,24 @@ import os
 import warnings
 from functools import partial
 import numpy as np
-import ruamel.yaml as yaml
 import jax
 import jax.numpy as jnp
-import dreamerv3
 from dreamerv3 import embodied
 from dreamerv3 import ninjax as nj
-import pickle
 
 from carl.envs.carl_env import CARLEnv
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
     _TASK2ENV,
     create_wrapped_carl_env,
 )
+from contextual_mbrl.dreamer.latent_store import LatentWriter
 
 logging.captureWarnings(True)
 if sys.platform == "linux":
@@ -73,15 +77,18 @@ def _wrap_dream_agent(agent):
         else:
             baseline_img = baseline_reconst["obs"].mode()
         report = {}
-        for z_dim in range(8):
-            sigma_z = ctx.reshape(-1, 8).std(0)[z_dim]
+        z_dims = jnp.arange(8)
+        sigmas = ctx.reshape(-1, 8).std(0)
+        signs = jax.random.choice(nj.rng(), jnp.array([-1, 1]), shape=(8, seq_len))
+
+        def counterfactual(z_dim, sign):
+            sigma_z = sigmas[z_dim]
             # delta = jax.random.uniform(nj.rng(), shape=(seq_len,), dtype=ctx.dtype, minval=sigma_z/2, maxval=sigma_z * 3)
             # sign = jax.random.choice(nj.rng(), jnp.array([-1, 1]), shape=(seq_len,))
             # ctx_perturbed = ctx.at[:, :, z_dim].add(delta * sign)
 
             # ctx_perturbed = ctx.at[:, :, z_dim].add(2.0 * sigma_z)
 
-            sign = jax.random.choice(nj.rng(), jnp.array([-1, 1]), shape=(seq_len,))
             ctx_perturbed = ctx.at[:, :, z_dim].add(sign * 3.0 * sigma_z)
 
             counterfactual_imagined = wm.rssm.imagine(
@@ -93,30 +100,34 @@ def _wrap_dream_agent(agent):
             }
             counterfactual_reconst = wm.heads["decoder"](counterfactual_imagined)
             if "image" in baseline_reconst.keys():
-                cf_img = counterfactual_reconst["image"].mode()
+                return counterfactual_reconst["image"].mode()
             else:
-                cf_img = counterfactual_reconst["obs"].mode()
+                return counterfactual_reconst["obs"].mode()
+
+        # Imagine the perturbations of all context dimensions at once.
+        cf_imgs = nj.vmap(counterfactual, z_dims, signs)
+        for z_dim in range(8):
             key = f"z_dim{z_dim}"
             report[key] = {
                 "original": baseline_img,
-                "imagined": cf_img
+                "imagined": cf_imgs[z_dim]
             }
         return report
     return gen_dream
 
-def record_dream(agent, env, args, ctx_info, logdir, dream_agent_fn, task,episodes):
-    big_dataset = {"original": {}, "imagined": {}}
-
+def record_dream(agent, env, args, ctx_info, logdir, dream_agent_fn, task,episodes, store):
     def per_episode(ep):
-        nonlocal agent, big_dataset, ctx_info, env
+        nonlocal agent, ctx_info, env
         batch = {k: np.stack([v], 0) for k, v in ep.items()}
         jax_batch = agent._convert_inps(batch, agent.train_devices)
         rng = agent._next_rngs(agent.train_devices)
         report, _ = dream_agent_fn(agent.varibs, rng, jax_batch)
         report = agent._convert_mets(report, agent.train_devices)
+        columns = {}
         for key in report.keys():
-            big_dataset["original"].setdefault(key, []).append(report[key]["original"])
-            big_dataset["imagined"].setdefault(key, []).append(report[key]["imagined"])
+            columns[f"original/{key}"] = report[key]["original"]
+            columns[f"imagined/{key}"] = report[key]["imagined"]
+        store.add(columns)
 
     driver = embodied.Driver(env)
     driver.on_episode(lambda ep, worker: per_episode(ep))
@@ -127,56 +138,31 @@ def record_dream(agent, env, args, ctx_info, logdir, dream_agent_fn, task,episod
 
     policy = lambda *args: agent.policy(*args, mode="eval")
     driver(policy, episodes=episodes)
-    return {
-            key: {
-            _key: np.concatenate(_val)
-                  for _key, _val in val.items()
-        }
-        for key, val in big_dataset.items()
-    }
-
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
-
-    # Parse only logdir and episodes
-    parsed, other = embodied.Flags(logdir="", episodes=150).parse_known()
-    logdir = embodied.Path(parsed.logdir)
 
+def record_logdir(logdir, parsed, other, agents):
     # Load configuration
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config["envs"]["amount"] = 20
-    config = embodied.Config(config)
-    config = embodied.Flags(config).parse(other)
-
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Load step counter
-    ckpt = embodied.Checkpoint()
-    ckpt.step = embodied.Counter()
-    ckpt.load(checkpoint, keys=["step"])
-    step = ckpt._values["step"]
+    config = load_config(logdir, other, envs={"amount": 20})
+    step = load_step(logdir / "checkpoint.ckpt")
 
     suite, task = config.task.split("_", 1)
     assert suite == "carl", suite
 
-    dream_agent_fn = None
-    agent = None
     env, ctx_info = generate_envs(config)
-    if agent is None:
-        agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-        dream_agent_fn = nj.pure(_wrap_dream_agent(agent.agent))
-        dream_agent_fn = nj.jit(dream_agent_fn, device=agent.train_devices[0])
+    agent = load_agent(agents, env, step, config)
+    dream_agent_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent)
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
         batch_steps=config.batch_size * config.batch_length,
     )
 
-    dataset = record_dream(
+    # dest_name = f"dataset_all_ep{parsed.episodes}"
+    # dest_name = f"dataset_all_ep{parsed.episodes}_sigma_div_2_to_sigma_times_3"
+    # dest_name = f"dataset_all_ep{parsed.episodes}_pos_2x_sigma"
+    dest_name = f"dataset_all_ep{parsed.episodes}_pos_neg_3x_sigma"
+    # Stream the dataset into a store, see latent_store.py for the format
+    store = LatentWriter(logdir / dest_name)
+    record_dream(
         agent,
         env,
         args,
@@ -185,17 +171,23 @@ def main():
         dream_agent_fn,
         task,
         parsed.episodes,
+        store,
     )
     env.close()
-
-    # dest_name = f"dataset_all_ep{parsed.episodes}.pkl"
-    # dest_name = f"dataset_all_ep{parsed.episodes}_sigma_div_2_to_sigma_times_3.pkl"
-    # dest_name = f"dataset_all_ep{parsed.episodes}_pos_2x_sigma.pkl"
-    dest_name = f"dataset_all_ep{parsed.episodes}_pos_neg_3x_sigma.pkl"
-    # Save the big dataset as a pkl file
-    with open(logdir / dest_name, "wb") as f:
-        pickle.dump(dataset, f)
+    store.close()
     print(f"Saved dataset to {logdir / dest_name}")
 
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+
+    # Parse one or more logdirs and episodes, runs with the same config share one agent
+    parsed, other = embodied.Flags(logdir=[""], episodes=150).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
+
 if __name__ == "__main__":
     main()
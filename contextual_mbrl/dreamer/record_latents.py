@@ -1,23 +1,27 @@
 import itertools
 import logging
 import os
-import pickle
 import warnings
 from functools import partial
 
-import dreamerv3
 import jax.numpy as jnp
 import numpy as np
-import ruamel.yaml as yaml
 from dreamerv3 import embodied
-from dreamerv3 import ninjax as nj
 
+from contextual_mbrl.dreamer.agent_cache import (
+    load_agent,
+    load_config,
+    load_dream_fn,
+    load_step,
+    load_weights,
+)
 from contextual_mbrl.dreamer.envs import (
     _TASK2CONTEXTS,
     _TASK2ENV,
     CARLEnv,
     create_wrapped_carl_env,
 )
+from contextual_mbrl.dreamer.latent_store import LatentWriter
 
 logging.captureWarnings(True)
 os.environ["MUJOCO_GL"] = "egl"  # use EGL instead of GLFW to render MuJoCo
@@ -163,98 +167,81 @@ def _wrap_dream_agent(agent):
     return gen_dream
 
 
-def collect_latents(agent, env, args, dream_agent_fn, episodes):
-    report = []
-
+def collect_latents(agent, env, args, dream_agent_fn, episodes, store, info):
     def per_episode(ep):
-        nonlocal agent, report
+        nonlocal agent
         batch = {k: np.stack([v], 0) for k, v in ep.items()}
         jax_batch = agent._convert_inps(batch, agent.train_devices)
         rng = agent._next_rngs(agent.train_devices)
         r, _ = dream_agent_fn(agent.varibs, rng, jax_batch)
         if r:
             r = agent._convert_mets(r, agent.train_devices)
-            report.append(r)
+            store.add(r, **info)
 
     driver = embodied.Driver(env)
     driver.on_episode(lambda ep, worker: per_episode(ep))
 
-    checkpoint = embodied.Checkpoint()
-    checkpoint.agent = agent
-    checkpoint.load(args.from_checkpoint, keys=["agent"])
-
     policy = lambda *args: agent.policy(*args, mode="eval")
     driver(policy, episodes=episodes)
 
-    return report
-
-
-def main():
-    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
-
-    warnings.filterwarnings("once", ".*If you want to use these environments.*")
-    warnings.filterwarnings("module", "carl.*")
 
-    # create argparse with logdir
-    parsed, other = embodied.Flags(logdir="", episodes=10).parse_known()
-    logdir = embodied.Path(parsed.logdir)
-    # load the config from the logdir
-    config = yaml.YAML(typ="safe").load((logdir / "config.yaml").read())
-    config = embodied.Config(config)
-    # parse the overrides for eval
-    config = embodied.Flags(config).parse(other)
-
-    checkpoint = logdir / "checkpoint.ckpt"
-    assert checkpoint.exists(), checkpoint
-    config = config.update({"run.from_checkpoint": str(checkpoint)})
-
-    # Just load the step counter from the checkpoint, as there is
-    # a circular dependency to load the agent.
-    ckpt = embodied.Checkpoint()
-    ckpt.step = embodied.Counter()
-    ckpt.load(checkpoint, keys=["step"])
-    step = ckpt._values["step"]
+def record_logdir(logdir, parsed, other, agents):
+    config = load_config(logdir, other)
+    step = load_step(logdir / "checkpoint.ckpt")
 
     dream_agent_fn = None
     agent = None
-    ctx2latent = []
     suite, task = config.task.split("_", 1)
     ctx_0 = _TASK2CONTEXTS[task][0]["context"]
     ctx_1 = _TASK2CONTEXTS[task][1]["context"]
 
+    # Episodes are streamed to disk, see latent_store.py for the format.
+    store = LatentWriter(logdir / "ctx2latent_v1")
     for env, ctx_info in gen_carl_collect_latent_envs(config):
 
         if agent is None:
-            agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-            dream_agent_fn = nj.pure(_wrap_dream_agent(agent.agent))
-            dream_agent_fn = nj.jit(dream_agent_fn, device=agent.train_devices[0])
+            agent = load_agent(agents, env, step, config)
+            dream_agent_fn = load_dream_fn(agents, agent, config, _wrap_dream_agent)
+            # Once per logdir, the contexts below all use these weights.
+            load_weights(agent, config.run.from_checkpoint)
         args = embodied.Config(
             **config.run,
             logdir=config.logdir,
             batch_steps=config.batch_size * config.batch_length,
         )
-        logs = collect_latents(
+        info = {
+            "context": {
+                ctx_0: ctx_info["context"][ctx_0],
+                ctx_1: ctx_info["context"][ctx_1],
+            },
+            "context_order": [ctx_0, ctx_1],
+        }
+        collect_latents(
             agent,
             env,
             args,
             dream_agent_fn,
             parsed.episodes,
-        )
-        ctx2latent.append(
-            {
-                "context": {
-                    ctx_0: ctx_info["context"][ctx_0],
-                    ctx_1: ctx_info["context"][ctx_1],
-                },
-                "context_order": [ctx_0, ctx_1],
-                "episodes": logs,
-            }
+            store,
+            info,
         )
         env.close()
-    # save ctx2latent
+    store.close()
+
+
+def main():
+    warnings.filterwarnings("ignore", ".*truncated to dtype int32.*")
 
-    with (logdir / "ctx2latent_v1.pkl").open("wb") as f:
-        pickle.dump(ctx2latent, f)
+    warnings.filterwarnings("once", ".*If you want to use these environments.*")
+    warnings.filterwarnings("module", "carl.*")
+
+    # create argparse with logdir
+    # logdir: one or more logdirs, runs with the same config share one agent
+    parsed, other = embodied.Flags(logdir=[""], episodes=10).parse_known()
+    agents = {}
+    for logdir in parsed.logdir:
+        print(f"Recording {logdir}")
+        record_logdir(embodied.Path(logdir), parsed, other, agents)
 
 
 if __name__ == "__main__":
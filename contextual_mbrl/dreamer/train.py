@@ -1,7 +1,9 @@
+import collections
 import sys
 import os
 import time
 import warnings
+from functools import partial as bind
 
 if sys.platform == "linux":
     os.environ["MUJOCO_GL"] = "egl"  # use EGL instead of GLFW to render MuJoCo
@@ -12,12 +14,45 @@ import dreamerv3
 import numpy as np
 import ruamel.yaml as yaml
 from dreamerv3 import embodied
+from dreamerv3.embodied.run.parallel import dummy_data
+from dreamerv3.embodied.run.parallel import env as env_worker
 
-from contextual_mbrl.dreamer.envs import make_envs
+from contextual_mbrl.dreamer.envs import make_env, make_envs
 
 warnings.filterwarnings("ignore")
 
 
+def log_episode(ep, logger, metrics, nonzeros, args):
+    length = len(ep["reward"]) - 1
+    score = float(ep["reward"].astype(np.float64).sum())
+    sum_abs_reward = float(np.abs(ep["reward"]).astype(np.float64).sum())
+    logger.add(
+        {
+            "length": length,
+            "score": score,
+            "sum_abs_reward": sum_abs_reward,
+            "reward_rate": (np.abs(ep["reward"]) >= 0.5).mean(),
+        },
+        prefix="episode",
+    )
+    print(f"Episode has {length} steps and return {score:.1f}.")
+    stats = {}
+    for key in args.log_keys_video:
+        if key in ep:
+            stats[f"policy_{key}"] = ep[key]
+    for key, value in ep.items():
+        if not args.log_zeros and key not in nonzeros and (value == 0).all():
+            continue
+        nonzeros.add(key)
+        if re.match(args.log_keys_sum, key):
+            stats[f"sum_{key}"] = ep[key].sum()
+        if re.match(args.log_keys_mean, key):
+            stats[f"mean_{key}"] = ep[key].mean()
+        if re.match(args.log_keys_max, key):
+            stats[f"max_{key}"] = ep[key].max(0).mean()
+    metrics.add(stats, prefix="stats")
+
+
 def train(agent, env, replay, logger, args):
     # copied from embodied.run.train and modified
     logdir = embodied.Path(args.logdir)
@@ -37,45 +72,30 @@ def train(agent, env, replay, logger, args):
     timer = embodied.Timer()
     timer.wrap("agent", agent, ["policy", "train", "report", "save"])
     timer.wrap("env", env, ["step"])
-    timer.wrap("replay", replay, ["add", "save"])
+    timer.wrap("replay", replay, ["add", "add_batch", "save"])
     timer.wrap("logger", logger, ["write"])
 
     nonzeros = set()
+    per_episode = lambda ep: log_episode(ep, logger, metrics, nonzeros, args)
 
-    def per_episode(ep):
-        length = len(ep["reward"]) - 1
-        score = float(ep["reward"].astype(np.float64).sum())
-        sum_abs_reward = float(np.abs(ep["reward"]).astype(np.float64).sum())
-        logger.add(
-            {
-                "length": length,
-                "score": score,
-                "sum_abs_reward": sum_abs_reward,
-                "reward_rate": (np.abs(ep["reward"]) >= 0.5).mean(),
-            },
-            prefix="episode",
-        )
-        print(f"Episode has {length} steps and return {score:.1f}.")
-        stats = {}
-        for key in args.log_keys_video:
-            if key in ep:
-                stats[f"policy_{key}"] = ep[key]
-        for key, value in ep.items():
-            if not args.log_zeros and key not in nonzeros and (value == 0).all():
-                continue
-            nonzeros.add(key)
-            if re.match(args.log_keys_sum, key):
-                stats[f"sum_{key}"] = ep[key].sum()
-            if re.match(args.log_keys_mean, key):
-                stats[f"mean_{key}"] = ep[key].mean()
-            if re.match(args.log_keys_max, key):
-                stats[f"max_{key}"] = ep[key].max(0).mean()
-        metrics.add(stats, prefix="stats")
-
-    driver = embodied.Driver(env)
+    # The async driver runs the policy on half of the envs while the other
+    # half steps.
+    if getattr(args, "async_envs", False):
+        driver = embodied.AsyncDriver(env)
+    else:
+        driver = embodied.Driver(env)
     driver.on_episode(lambda ep, worker: per_episode(ep))
-    driver.on_step(lambda tran, _: step.increment())
-    driver.on_step(replay.add)
+    # Batched callbacks see the transitions of all envs at once, so the step
+    # counter, replay and train step run once per env step instead of once
+    # per env.
+    if getattr(args, "batch_callbacks", False):
+        on_step = driver.on_batch
+        on_step(lambda trans, workers: step.increment(len(workers)))
+        on_step(replay.add_batch)
+    else:
+        on_step = driver.on_step
+        on_step(lambda tran, _: step.increment())
+        on_step(replay.add)
 
     print("Prefill train dataset.")
     random_agent = embodied.RandomAgent(env.act_space)
@@ -107,9 +127,10 @@ def train(agent, env, replay, logger, args):
             logger.add(report, prefix="report")
             logger.add(replay.stats, prefix="replay")
             logger.add(timer.stats(), prefix="timer")
+            logger.add(dataset.stats(), prefix="dataset")
             logger.write(fps=True)
 
-    driver.on_step(train_step)
+    on_step(train_step)
 
     checkpoint = embodied.Checkpoint(logdir / "checkpoint.ckpt")
     timer.wrap("checkpoint", checkpoint, ["save", "load"])
@@ -136,6 +157,186 @@ def train(agent, env, replay, logger, args):
     logger.write()
 
 
+
+def train_parallel(agent, replay, logger, make_env, num_envs, args):
+    """Actor/learner variant of train() following embodied.run.parallel.
+
+    Env processes send their observations to a batched actor server that runs
+    the policy and adds the transitions to the replay, while a learner thread
+    trains on the replay at the same time. The replay limiter keeps the ratio
+    of samples to inserts close to the train ratio. Returns once the step
+    counter reached args.steps. make_env receives the index of the env, which
+    offsets its seed.
+    """
+    logdir = embodied.Path(args.logdir)
+    logdir.mkdirs()
+    print("Logdir", logdir)
+    step = logger.step
+    timer = embodied.Timer()
+    timer.wrap("agent", agent, ["policy", "train", "report", "save"])
+    timer.wrap("replay", replay, ["add", "add_batch", "save"])
+    timer.wrap("logger", logger, ["write"])
+
+    # Load before any worker starts, so the actor does not add to the replay
+    # that is being restored.
+    checkpoint = embodied.Checkpoint(logdir / "checkpoint.ckpt")
+    timer.wrap("checkpoint", checkpoint, ["save", "load"])
+    checkpoint.step = step
+    checkpoint.agent = agent
+    checkpoint.replay = replay
+    if args.from_checkpoint:
+        checkpoint.load(args.from_checkpoint)
+    checkpoint.load_or_save()
+
+    actor_addr = args.actor_addr.format(pid=os.getpid())
+    actor = embodied.distr.Thread(
+        parallel_actor, agent, replay, logger, actor_addr, args, name="actor"
+    )
+    learner = embodied.distr.Thread(
+        parallel_learner, agent, replay, logger, checkpoint, timer, args,
+        name="learner",
+    )
+    if num_envs == 1:
+        envs = [
+            embodied.distr.Thread(
+                env_worker, bind(make_env, index=0), actor_addr, 0, args, timer
+            )
+        ]
+    else:
+        envs = [
+            embodied.distr.Process(
+                env_worker, bind(make_env, index=i), actor_addr, i, args
+            )
+            for i in range(num_envs)
+        ]
+    # The actor and the envs serve forever and are shut down with the learner.
+    embodied.distr.run([actor, learner, *envs], until=[learner])
+    logger.write()
+
+
+def parallel_actor(agent, replay, logger, actor_addr, args):
+    step = logger.step
+    metrics = embodied.Metrics()
+    nonzeros = set()
+    episodes = collections.defaultdict(lambda: collections.defaultdict(list))
+    should_expl = embodied.when.Until(args.expl_until)
+    should_log = embodied.when.Clock(args.log_every)
+
+    _, initial = agent.policy(dummy_data(agent.agent.obs_space, (args.actor_batch,)))
+    initial = embodied.treemap(lambda x: x[0], initial)
+    allstates = collections.defaultdict(lambda: initial)
+    agent.sync()
+
+    def callback(obs, env_addrs):
+        # The server reuses its input arrays for the next batch.
+        obs = {k: v.copy() for k, v in obs.items()}
+        states = [allstates[a] for a in env_addrs]
+        states = embodied.treemap(lambda *xs: list(xs), *states)
+        mode = "explore" if should_expl(step) else "train"
+        act, states = agent.policy(obs, states, mode=mode)
+        act["reset"] = obs["is_last"].copy()
+        for i, a in enumerate(env_addrs):
+            allstates[a] = embodied.treemap(lambda x: x[i], states)
+
+        trans = {**obs, **act}
+        replay.add_batch(trans, env_addrs)
+        step.increment(len(env_addrs))
+        for i, a in enumerate(env_addrs):
+            [episodes[a][k].append(v[i]) for k, v in trans.items()]
+            if trans["is_last"][i]:
+                ep = {k: embodied.convert(v) for k, v in episodes.pop(a).items()}
+                log_episode(ep, logger, metrics, nonzeros, args)
+        if should_log():
+            logger.add(metrics.result())
+        return act
+
+    print("[actor] Start server")
+    embodied.BatchServer(actor_addr, args.actor_batch, callback).run()
+
+
+def parallel_learner(agent, replay, logger, checkpoint, timer, args):
+    step = logger.step
+    metrics = embodied.Metrics()
+    should_log = embodied.when.Clock(args.log_every)
+    should_save = embodied.when.Clock(args.save_every)
+    should_sync = embodied.when.Every(args.sync_every)
+    updates = embodied.Counter()
+    should_save(step)  # Register that we just saved.
+
+    dataset = agent.dataset(replay.dataset)
+    state = None
+    stats = dict(last_time=time.time(), last_step=int(step), batch_entries=0)
+    print("Start training loop.")
+    while step < args.steps:
+        with timer.scope("dataset"):
+            batch = next(dataset)
+        outs, state, mets = agent.train(batch, state)
+        metrics.add(mets, prefix="train")
+        if "priority" in outs:
+            replay.prioritize(outs["key"], outs["priority"])
+        updates.increment()
+        stats["batch_entries"] += batch["is_first"].size
+
+        if should_sync(updates):
+            agent.sync()
+
+        if should_log():
+            agg = metrics.result()
+            report = agent.report(batch)
+            report = {k: v for k, v in report.items() if "train/" + k not in agg}
+            logger.add(agg)
+            logger.add(report, prefix="report")
+            logger.add(replay.stats, prefix="replay")
+            logger.add(timer.stats(), prefix="timer")
+            logger.add(dataset.stats(), prefix="dataset")
+            duration = time.time() - stats["last_time"]
+            actor_fps = (int(step) - stats["last_step"]) / duration
+            learner_fps = stats["batch_entries"] / duration
+            logger.add(
+                {
+                    "actor_fps": actor_fps,
+                    "learner_fps": learner_fps,
+                    "train_ratio": learner_fps / actor_fps if actor_fps else np.inf,
+                },
+                prefix="parallel",
+            )
+            stats = dict(last_time=time.time(), last_step=int(step), batch_entries=0)
+            logger.write(fps=True)
+
+        if should_save():
+            checkpoint.save()
+    # save the final checkpoint
+    checkpoint.save()
+    if checkpoint._parallel:
+        checkpoint._worker.shutdown(wait=True)
+
+
+def make_replay(config, directory, rate_limit=False):
+    kw = {}
+    if rate_limit and config.run.train_ratio > 0:
+        # Inserts wait for the learner and samples wait for the actor, so the
+        # learner trains at the train ratio instead of as fast as it can.
+        kw["samples_per_insert"] = config.run.train_ratio / config.batch_length
+        kw["tolerance"] = 10 * config.batch_size
+        kw["min_size"] = config.batch_size
+    if config.replay == "ring":
+        return embodied.replay.UniformRing(
+            config.batch_length, config.replay_size, directory, **kw
+        )
+    if config.replay == "prioritized":
+        # Sequences are prioritized by their world model loss, see Agent.train.
+        return embodied.replay.PrioritizedRing(
+            config.batch_length,
+            config.replay_size,
+            directory,
+            exponent=getattr(config, "replay_exponent", 1.0),
+            **kw,
+        )
+    return embodied.replay.Uniform(
+        config.batch_length, config.replay_size, directory, **kw
+    )
+
+
 def main():
 
     # import sys
@@ -159,6 +360,10 @@ def main():
     for name in parsed.configs:
         config = config.update(master_config[name])
     config = embodied.Flags(config).parse(other)
+    # The actor server waits for a full batch, so it cannot be larger than
+    # the number of envs that send observations.
+    if config.run.actor_batch > config.envs.amount:
+        config = config.update({"run.actor_batch": config.envs.amount})
     logdir = embodied.Path(config.logdir)
     logdir.mkdirs()
     config.save(logdir / "config.yaml")
@@ -185,17 +390,25 @@ def main():
 
     logger = embodied.Logger(step, loggers)
 
-    env = make_envs(config)
-    agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
-    replay = embodied.replay.Uniform(
-        config.batch_length, config.replay_size, logdir / "replay"
-    )
     args = embodied.Config(
         **config.run,
         logdir=config.logdir,
         batch_steps=config.batch_size * config.batch_length,
     )
-    train(agent, env, replay, logger, args)
+    if config.run.script == "parallel":
+        # Only needed for the spaces, every env process builds its own env.
+        env = make_env(config, index=0)
+        agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
+        env.close()
+        replay = make_replay(config, logdir / "replay", rate_limit=True)
+        train_parallel(
+            agent, replay, logger, bind(make_env, config), config.envs.amount, args
+        )
+    else:
+        env = make_envs(config)
+        agent = dreamerv3.Agent(env.obs_space, env.act_space, step, config)
+        replay = make_replay(config, logdir / "replay")
+        train(agent, env, replay, logger, args)
 
 
 if __name__ == "__main__":
@@ -56,7 +56,6 @@ class Agent(nj.Module):
                 self.wm, self.act_space, self.config, name="expl_behavior"
             )
         self.stack_len = config.batch_length
-        self.num_envs = config.envs.amount
         self.img_encoder_dim = None
 
     def policy_initial(self, batch_size):
@@ -64,11 +63,27 @@ class Agent(nj.Module):
             self.wm.initial(batch_size),
             self.task_behavior.initial(batch_size),
             self.expl_behavior.initial(batch_size),
-            jnp.zeros((self.num_envs, self.stack_len, self.obs_space["obs"].shape[0]), dtype=jnp.float32),
-            jnp.zeros((self.num_envs, self.stack_len, self.act_space.shape[0]), dtype=jnp.float32),
-            jnp.zeros((self.num_envs, self.stack_len, self.img_encoder_dim), dtype=jnp.float32),
+            self._ctx_initial(batch_size),
         )
 
+    def _ctx_initial(self, batch_size):
+        if not self.wm.use_ctx_encoder:
+            return {}
+        if self._incremental_ctx():
+            return self.wm.ctx_encoder.initial(batch_size, self.stack_len)
+        # Ring buffer holding the last stack_len inputs of the context encoder.
+        dims = {
+            "obs": self.obs_space["obs"].shape[0],
+            "action": self.act_space.shape[0],
+            "embed": self.img_encoder_dim,
+        }
+        state = {
+            k: jnp.zeros((batch_size, self.stack_len, dims[k]), dtype=jnp.float32)
+            for k in self.config.ctx_encoder.inputs
+        }
+        state["index"] = jnp.zeros(batch_size, jnp.int32)
+        return state
+
     def train_initial(self, batch_size):
         return self.wm.initial(batch_size)
 
@@ -76,28 +91,19 @@ class Agent(nj.Module):
         self.config.jax.jit and print("Tracing policy function.")
         obs = self.preprocess(obs)
 
-        (prev_latent, prev_action), task_state, expl_state, obs_stack, act_stack, embed_stack = state
-        # input the latest obs at the first position shift the window 1 to the left
-        obs_stack = obs_stack.at[:, 0].set(obs["obs"])
-        obs_stack = jnp.roll(obs_stack, shift=-1, axis=1)
-        act_stack = act_stack.at[:, 0].set(prev_action)
-        act_stack = jnp.roll(act_stack, shift=-1, axis=1)
-
+        (prev_latent, prev_action), task_state, expl_state, ctx_state = state
         embed = self.wm.encoder(obs)
-        embed_stack = embed_stack.at[:, 0].set(embed)
-        embed_stack = jnp.roll(embed_stack, shift=-1, axis=1)
 
         # ADD
         dcontext = None
         if self.wm.rssm._add_dcontext:
             dcontext = obs["context"]
         elif self.wm.use_ctx_encoder:
-            dummy_len_dcontext = self.wm.ctx_encoder({
-                "action": act_stack,
-                "obs": obs_stack,
-                "embed": embed_stack if 'embed' in self.config.ctx_encoder.inputs else None
+            dcontext, ctx_state = self._ctx_step(ctx_state, {
+                "action": prev_action,
+                "obs": obs["obs"],
+                "embed": embed,
             })
-            dcontext = dummy_len_dcontext[:, -1]
 
         # OLD
         # dcontext = obs["context"] if self.wm.rssm._add_dcontext else None
@@ -130,9 +136,28 @@ class Agent(nj.Module):
             outs["log_entropy"] = outs["action"].entropy()
             outs["action"] = outs["action"].sample(seed=nj.rng())
 
-        state = ((latent, outs["action"]), task_state, expl_state, obs_stack, act_stack, embed_stack)
+        state = ((latent, outs["action"]), task_state, expl_state, ctx_state)
         return outs, state
 
+    def _ctx_step(self, ctx_state, inputs):
+        if self._incremental_ctx():
+            return self.wm.ctx_encoder.step(ctx_state, inputs)
+        # Write the newest step at the ring index and read the window back
+        # from the oldest to the newest step.
+        index = ctx_state["index"]
+        rows = jnp.arange(len(index))
+        order = (index[:, None] + 1 + jnp.arange(self.stack_len)) % self.stack_len
+        stacks, window = {"index": (index + 1) % self.stack_len}, {}
+        for key in self.config.ctx_encoder.inputs:
+            stacks[key] = ctx_state[key].at[rows, index].set(inputs[key])
+            window[key] = jnp.take_along_axis(stacks[key], order[:, :, None], 1)
+        return self.wm.ctx_encoder(window)[:, -1], stacks
+
+    def _incremental_ctx(self):
+        encoder = self.wm.ctx_encoder
+        incremental = getattr(self.config.ctx_encoder, "incremental", False)
+        return incremental and (encoder.causal or encoder.network_type == "gru")
+
     def train(self, data, state):
         self.config.jax.jit and print("Tracing train function.")
         metrics = {}
@@ -161,6 +186,15 @@ class Agent(nj.Module):
             _, mets = self.expl_behavior.train(self.wm.imagine, start, context)
             metrics.update({"expl_" + key: value for key, value in mets.items()})
         outs = {}
+        if "key" in data:
+            # Prioritized replay samples the sequences with the largest world
+            # model loss, including the DALI loss, more often.
+            losses = [
+                self.wm.scales[k[: -len("_loss")]] * v.reshape((len(v), -1)).mean(-1)
+                for k, v in wm_outs.items()
+                if k.endswith("_loss")
+            ]
+            outs = {"key": data["key"], "priority": sum(losses)}
         return outs, state, metrics
 
     def report(self, data):
@@ -294,77 +328,7 @@ class WorldModel(nj.Module):
             losses[key] = loss
         # Forward model loss to shape context encoding
         if self.use_ctx_encoder:
-            ctx_lossses = []
-            for t in range(1, data["obs"].shape[1]):
-                pad_width = data["obs"].shape[1] - t
-                padded_obs = jnp.pad(
-                    data["obs"][:, :t],
-                    ((0, 0), (pad_width, 0), (0, 0)),
-                    mode='edge'
-                )
-                padded_action = jnp.pad(
-                    data["action"][:, :t],
-                    ((0, 0), (pad_width, 0), (0, 0)),
-                    mode='edge'
-                )
-                if 'embed' in self.config.ctx_encoder.inputs:
-                    padded_embed = jnp.pad(
-                        embed[:, :t],
-                        ((0, 0), (pad_width, 0), (0, 0)),
-                        mode='edge'
-                    )
-                else:
-                    padded_embed = None
-
-                ctx_enc_data = {
-                    "action": padded_action,
-                    "obs": padded_obs,
-                    "embed": padded_embed
-                }
-                rolling_ctx = self.ctx_encoder(ctx_enc_data)
-
-                is_first = cast(data["is_first"][:, t])
-                prev_action = cast(prev_action)
-                if self.rssm._action_clip > 0.0:
-                    prev_action *= sg(
-                        self.rssm._action_clip / jnp.maximum(self.rssm._action_clip, jnp.abs(prev_action))
-                    )
-                prev_state, prev_action = jax.tree_util.tree_map(
-                    lambda x: self.rssm._mask(x, 1.0 - data["is_first"][:, t]), (prev_latent, prev_action)
-                )
-                prev_state = jax.tree_util.tree_map(
-                    lambda x, y: x + self.rssm._mask(y, data["is_first"][:, t]),
-                    prev_state,
-                    self.rssm.initial(len(data["is_first"][:, t])),
-                )
-
-                # calculate h_t and prior (\hat{z}_t) based on prev state and action
-                ctx_prior = self.rssm.img_step(sg(prev_state), prev_action, dcontext=sg(rolling_ctx[:, -1]))
-                x = jnp.concatenate([sg(ctx_prior["deter"]), embed[:, t]], -1)
-                # calculate z_t (posterior) based on prior h_t and embedding of o_t
-                x = self.rssm.get("obs_out", nets.Linear, **self.rssm._kw)(x)
-                stats = self.rssm._stats("obs_stats", x)
-                dist = self.rssm.get_dist(stats)
-                stoch = dist.sample(seed=nj.rng())
-                ctx_post = {"stoch": stoch, "deter": ctx_prior["deter"], **stats}
-                ctx_post, ctx_prior = cast(ctx_post), cast(ctx_prior)
-
-                loss_fd = self.ctx_encoder.compute_loss({
-                    **ctx_enc_data,
-                    "context": rolling_ctx
-                })
-                if self.config.ctx_encoder.crossmodal:
-                    loss_cross = self.ctx_encoder.reconstruct_wm_state_loss(
-                        rolling_ctx[:, -1],
-                        ctx_post["stoch"].reshape(ctx_post["stoch"].shape[0], -1)
-                    )
-                    ctx_lossses.append(loss_fd + self.config.ctx_encoder.lambda_cross * loss_cross)
-                else:
-                    ctx_lossses.append(loss_fd)
-
-                prev_latent = ctx_post
-                prev_action = data["action"][:, t]
-            losses["dali"] = jnp.concatenate([jnp.stack(ctx_lossses, axis=1), jnp.zeros((data["obs"].shape[0], 1))], axis=-1)
+            losses["dali"] = self._dali_loss(data, embed, prev_latent, prev_action)
 
         if hasattr(self.config, "use_context_head") and self.config.use_context_head:
             pure_context_head_fn = nj.pure(
@@ -385,6 +349,111 @@ class WorldModel(nj.Module):
         metrics = self._metrics(data, dists, post, prior, losses, model_loss)
         return model_loss.mean(), (state, out, metrics)
 
+    def _dali_loss(self, data, embed, prev_latent, prev_action):
+        # Every step t >= 1 encodes the edge-padded window of steps [0, t) and
+        # uses that context to infer the latent of step t.
+        batch_size, batch_len = data["obs"].shape[:2]
+        use_embed = "embed" in self.config.ctx_encoder.inputs
+        actions = jnp.concatenate([prev_action[:, None], data["action"][:, 1:-1]], 1)
+        windows = getattr(self.config.ctx_encoder, "windows", "loop")
+        ctx_post = None
+        if self.ctx_encoder.causal:
+            # The context of the prefix [0, t) is the causal output at t - 1.
+            ctx_enc_data = {
+                "action": data["action"],
+                "obs": data["obs"],
+                "embed": embed if use_embed else None,
+            }
+            rolling_ctx = self.ctx_encoder(ctx_enc_data)
+            loss_fd = self.ctx_encoder.compute_loss({
+                **ctx_enc_data,
+                "context": rolling_ctx
+            }, reduce=False)
+            ctx = rolling_ctx[:, :-1]
+        elif windows == "batched":
+            # Gather all windows at once so the encoder runs in a single pass
+            # over [B * (T - 1), T, D] instead of being traced T - 1 times.
+            steps = jnp.arange(1, batch_len)[:, None]
+            index = jnp.maximum(jnp.arange(batch_len)[None] - batch_len + steps, 0)
+            flatten = lambda x: x[:, index].reshape((-1, batch_len) + x.shape[2:])
+            ctx_enc_data = {
+                "action": flatten(data["action"]),
+                "obs": flatten(data["obs"]),
+                "embed": flatten(embed) if use_embed else None,
+            }
+            rolling_ctx = self.ctx_encoder(ctx_enc_data)
+            loss_fd = self.ctx_encoder.compute_loss({
+                **ctx_enc_data,
+                "context": rolling_ctx
+            }).reshape((batch_size, batch_len - 1))
+            ctx = rolling_ctx[:, -1].reshape((batch_size, batch_len - 1, -1))
+        elif windows == "loop":
+            ctx, loss_fd, ctx_post = [], [], []
+            for t in range(1, batch_len):
+                pad = lambda x: jnp.pad(
+                    x[:, :t], ((0, 0), (batch_len - t, 0), (0, 0)), mode="edge"
+                )
+                ctx_enc_data = {
+                    "action": pad(data["action"]),
+                    "obs": pad(data["obs"]),
+                    "embed": pad(embed) if use_embed else None,
+                }
+                rolling_ctx = self.ctx_encoder(ctx_enc_data)
+                loss_fd.append(self.ctx_encoder.compute_loss({
+                    **ctx_enc_data,
+                    "context": rolling_ctx
+                }))
+                ctx.append(rolling_ctx[:, -1])
+                inputs = (actions[:, t - 1], embed[:, t], data["is_first"][:, t], ctx[-1])
+                prev_latent = self._dali_step(prev_latent, inputs)
+                ctx_post.append(prev_latent)
+            ctx, loss_fd = jnp.stack(ctx, 1), jnp.stack(loss_fd, 1)
+            ctx_post = {k: jnp.stack([x[k] for x in ctx_post], 1) for k in ctx_post[0]}
+        else:
+            raise NotImplementedError(windows)
+        if ctx_post is None:
+            swap = lambda x: x.transpose([1, 0] + list(range(2, len(x.shape))))
+            inputs = (actions, embed[:, 1:], data["is_first"][:, 1:], ctx)
+            ctx_post = jaxutils.scan(
+                self._dali_step, tree_map(swap, inputs), prev_latent, self.rssm._unroll
+            )
+            ctx_post = {k: swap(v) for k, v in ctx_post.items()}
+
+        loss = loss_fd
+        if self.config.ctx_encoder.crossmodal:
+            loss_cross = self.ctx_encoder.reconstruct_wm_state_loss(
+                ctx, ctx_post["stoch"].reshape(ctx_post["stoch"].shape[:2] + (-1,))
+            )
+            loss = loss_fd + self.config.ctx_encoder.lambda_cross * loss_cross
+        return jnp.concatenate([loss, jnp.zeros((batch_size, 1))], axis=-1)
+
+    def _dali_step(self, prev_latent, inputs):
+        prev_action, embed, is_first, ctx = inputs
+        is_first = cast(is_first)
+        prev_action = cast(prev_action)
+        if self.rssm._action_clip > 0.0:
+            prev_action *= sg(
+                self.rssm._action_clip / jnp.maximum(self.rssm._action_clip, jnp.abs(prev_action))
+            )
+        prev_state, prev_action = jax.tree_util.tree_map(
+            lambda x: self.rssm._mask(x, 1.0 - is_first), (prev_latent, prev_action)
+        )
+        prev_state = jax.tree_util.tree_map(
+            lambda x, y: x + self.rssm._mask(y, is_first),
+            prev_state,
+            self.rssm.initial(len(is_first)),
+        )
+
+        # calculate h_t and prior (\hat{z}_t) based on prev state and action
+        ctx_prior = self.rssm.img_step(sg(prev_state), prev_action, dcontext=sg(ctx))
+        x = jnp.concatenate([sg(ctx_prior["deter"]), embed], -1)
+        # calculate z_t (posterior) based on prior h_t and embedding of o_t
+        x = self.rssm.get("obs_out", nets.Linear, **self.rssm._kw)(x)
+        stats = self.rssm._stats("obs_stats", x)
+        dist = self.rssm.get_dist(stats)
+        stoch = dist.sample(seed=nj.rng())
+        return cast({"stoch": stoch, "deter": ctx_prior["deter"], **stats})
+
     def imagine(self, policy, start, horizon):
         first_cont = (1.0 - start["is_terminal"]).astype(jnp.float32)
         keys = list(self.rssm.initial(1).keys())
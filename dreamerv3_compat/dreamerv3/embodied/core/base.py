@@ -103,6 +103,10 @@ class Replay:
   def add(self, transition, worker=0):
     raise NotImplementedError('Returns: None')
 
+  def add_batch(self, transitions, workers):
+    for i, worker in enumerate(workers):
+      self.add({k: v[i] for k, v in transitions.items()}, worker)
+
   def add_traj(self, trajectory):
     raise NotImplementedError('Returns: None')
 
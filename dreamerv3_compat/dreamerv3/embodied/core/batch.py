@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 
 from . import base
@@ -5,12 +7,17 @@ from . import base
 
 class BatchEnv(base.Env):
 
-  def __init__(self, envs, parallel):
+  def __init__(self, envs, parallel, shared=False):
     assert all(len(env) == 0 for env in envs)
     assert len(envs) > 0
+    assert parallel or not shared
     self._envs = envs
     self._parallel = parallel
     self._keys = list(self.obs_space.keys())
+    self._memory = {}
+    self._buffers = {}
+    self._pending = {}
+    shared and self._share()
 
   @property
   def obs_space(self):
@@ -32,14 +39,84 @@ class BatchEnv(base.Env):
       obs.append(env.step(act))
     if self._parallel:
       obs = [ob() for ob in obs]
-    return {k: np.array([ob[k] for ob in obs]) for k in obs[0]}
+    if not self._buffers:
+      return {k: np.array([ob[k] for ob in obs]) for k in obs[0]}
+    for i, ob in enumerate(obs):
+      # Workers that were restarted or cannot share return their observation.
+      for key in self._buffers.keys() & ob.keys():
+        self._buffers[key][i] = ob.pop(key)
+    # The shared buffers are returned without copying and are overwritten by
+    # the next step.
+    rest = {k: np.array([ob[k] for ob in obs]) for k in obs[0]}
+    return {**self._buffers, **rest}
+
+  def send(self, action, indices):
+    """Starts stepping the envs at indices without waiting for them. Their
+    observations are collected by recv."""
+    assert all(len(v) == len(indices) for v in action.values()), (
+        len(indices), {k: v.shape for k, v in action.items()})
+    for i, index in enumerate(indices):
+      assert index not in self._pending, index
+      act = {k: v[i] for k, v in action.items()}
+      ob = self._envs[index].step(act)
+      self._pending[index] = ob if self._parallel else (lambda ob=ob: ob)
+
+  def recv(self, count, sleep=0.0001):
+    """Waits until count of the sent envs have finished their step and
+    returns their indices and observations. Among the ready envs, the ones
+    that were sent first are returned first, so no env is starved."""
+    assert count <= len(self._pending), (count, len(self._pending))
+    while True:
+      ready = [
+          index for index, ob in self._pending.items()
+          if getattr(ob, 'done', lambda: True)()]
+      if len(ready) >= count:
+        break
+      time.sleep(sleep)
+    indices = np.array(ready[:count])
+    obs = [self._pending.pop(index)() for index in indices]
+    if not self._buffers:
+      return indices, {k: np.array([ob[k] for ob in obs]) for k in obs[0]}
+    for index, ob in zip(indices, obs):
+      for key in self._buffers.keys() & ob.keys():
+        self._buffers[key][index] = ob.pop(key)
+    # Indexing copies the rows, so they stay valid while other envs step.
+    rest = {k: np.array([ob[k] for ob in obs]) for k in obs[0]}
+    return indices, {**{k: v[indices] for k, v in self._buffers.items()}, **rest}
+
+  def _share(self):
+    from multiprocessing import shared_memory
+    specs = {}
+    for key, space in self.obs_space.items():
+      shape = (len(self._envs),) + space.shape
+      size = int(np.prod(shape)) * np.dtype(space.dtype).itemsize
+      memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+      self._memory[key] = memory
+      self._buffers[key] = np.ndarray(shape, space.dtype, buffer=memory.buf)
+      specs[key] = (memory.name, shape, space.dtype)
+    for index, env in enumerate(self._envs):
+      env.share(specs, index)
 
   def render(self):
     return np.stack([env.render() for env in self._envs])
 
   def close(self):
+    for ob in self._pending.values():
+      try:
+        ob()
+      except Exception:
+        pass
+    self._pending.clear()
     for env in self._envs:
       try:
         env.close()
       except Exception:
         pass
+    self._buffers.clear()
+    for memory in self._memory.values():
+      memory.unlink()
+      try:
+        memory.close()
+      except BufferError:
+        pass  # Views of the buffer are still alive elsewhere.
+    self._memory.clear()
@@ -1,7 +1,6 @@
 import queue as queuelib
 import sys
 import threading
-import time
 import traceback
 
 import numpy as np
@@ -11,14 +10,20 @@ class Batcher:
 
   def __init__(
       self, sources, workers=0, postprocess=None,
-      prefetch_source=4, prefetch_batch=2):
+      prefetch_source=4, prefetch_batch=2, stack=True):
+    # Without stacking, the single source already yields whole batches.
+    assert stack or len(sources) == 1, len(sources)
     self._workers = workers
     self._postprocess = postprocess
+    self._stack = stack
     if workers:
       # Round-robin assign sources to workers.
       self._running = True
       self._threads = []
       self._queues = []
+      # Notified whenever the batcher takes elements out of the queues, so
+      # creators whose queues are all full sleep until there is space.
+      self._space = threading.Condition()
       assignments = [([], []) for _ in range(workers)]
       for index, source in enumerate(sources):
         queue = queuelib.Queue(prefetch_source)
@@ -62,23 +67,27 @@ class Batcher:
       batch = self._batches.get()
     else:
       elems = [next(x) for x in self._iterators]
-      batch = {k: np.stack([x[k] for x in elems], 0) for k in elems[0]}
+      batch = self._combine(elems)
     if isinstance(batch, Exception):
       raise batch
     return batch
 
+  def _combine(self, elems):
+    if not self._stack:
+      return elems[0]
+    return {k: np.stack([x[k] for x in elems], 0) for k in elems[0]}
+
   def _creator(self, sources, outputs):
     try:
       iterators = [source() for source in sources]
       while self._running:
-        waiting = True
         for iterator, queue in zip(iterators, outputs):
           if queue.full():
             continue
           queue.put(next(iterator))
-          waiting = False
-        if waiting:
-          time.sleep(0.001)
+        with self._space:
+          while self._running and all(queue.full() for queue in outputs):
+            self._space.wait(0.1)  # Time out to notice when closed.
     except Exception as e:
       e.stacktrace = ''.join(traceback.format_exception(*sys.exc_info()))
       outputs[0].put(e)
@@ -88,10 +97,12 @@ class Batcher:
     try:
       while self._running:
         elems = [x.get() for x in sources]
+        with self._space:
+          self._space.notify_all()
         for elem in elems:
           if isinstance(elem, Exception):
             raise elem
-        batch = {k: np.stack([x[k] for x in elems], 0) for k in elems[0]}
+        batch = self._combine(elems)
         if self._postprocess:
           batch = self._postprocess(batch)
         output.put(batch)  # Will wait here if the queue is full.
@@ -188,6 +188,12 @@ class Process:
 
   def terminate(self):
     self._process.terminate()
+    # Native libraries of some envs catch SIGTERM, kill the process if it
+    # does not stop on its own.
+    self._process.join(5)
+    if self._process.exitcode is None:
+      self._process.kill()
+      self._process.join()
     print('Shut down worker:', self.name)
 
   def _wrapper(self, lock, fn, *args):
@@ -206,10 +212,15 @@ class Process:
       raise
 
 
-def run(workers):
+def run(workers, until=None):
+  """Starts the workers and waits for them. With until, returns as soon as
+  those workers terminated successfully and shuts down the others, which is
+  useful for workers that serve forever."""
+  until = workers if until is None else until
   [x.start() for x in workers]
   while True:
-    if all(x.exitcode == 0 for x in workers):
+    if all(x.exitcode == 0 for x in until):
+      [x.terminate() for x in workers if x.exitcode is None]
       print('All workers terminated successfully.')
       return
     for worker in workers:
@@ -1,8 +1,6 @@
-import collections
-
 import numpy as np
 
-from .basics import convert
+from .basics import convert, treemap
 
 
 class Driver:
@@ -14,11 +12,16 @@ class Driver:
       bool: bool,
   }
 
+  # Initial number of steps per env in the episode buffers, which double in
+  # length whenever an episode outgrows them.
+  _CAPACITY = 256
+
   def __init__(self, env, **kwargs):
     assert len(env) > 0
     self._env = env
     self._kwargs = kwargs
     self._on_steps = []
+    self._on_batches = []
     self._on_episodes = []
     self.reset()
 
@@ -27,12 +30,18 @@ class Driver:
         k: convert(np.zeros((len(self._env),) + v.shape, v.dtype))
         for k, v in self._env.act_space.items()}
     self._acts['reset'] = np.ones(len(self._env), bool)
-    self._eps = [collections.defaultdict(list) for _ in range(len(self._env))]
+    self._eps = {}
+    self._lengths = np.zeros(len(self._env), np.int64)
     self._state = None
 
   def on_step(self, callback):
     self._on_steps.append(callback)
 
+  def on_batch(self, callback):
+    """Register a callback that receives the transitions of all envs at once,
+    as arrays with the env along the first axis, and the array of workers."""
+    self._on_batches.append(callback)
+
   def on_episode(self, callback):
     self._on_episodes.append(callback)
 
@@ -46,6 +55,9 @@ class Driver:
     acts = {k: v for k, v in self._acts.items() if not k.startswith('log_')}
     obs = self._env.step(acts)
     obs = {k: convert(v) for k, v in obs.items()}
+    # Transitions outlive the step, so copy views into buffers that the env
+    # reuses, such as shared memory observations.
+    obs = {k: v if v.flags.owndata else v.copy() for k, v in obs.items()}
     assert all(len(x) == len(self._env) for x in obs.values()), obs
     acts, self._state = policy(obs, self._state, **self._kwargs)
     acts = {k: convert(v) for k, v in acts.items()}
@@ -54,25 +66,105 @@ class Driver:
       acts = {k: v * self._expand(mask, len(v.shape)) for k, v in acts.items()}
     acts['reset'] = obs['is_last'].copy()
     self._acts = acts
-    trns = {**obs, **acts}
-    if obs['is_first'].any():
-      for i, first in enumerate(obs['is_first']):
-        if first:
-          self._eps[i].clear()
-    for i in range(len(self._env)):
-      trn = {k: v[i] for k, v in trns.items()}
-      [self._eps[i][k].append(v) for k, v in trn.items()]
-      [fn(trn, i, **self._kwargs) for fn in self._on_steps]
-      step += 1
-    if obs['is_last'].any():
-      for i, done in enumerate(obs['is_last']):
-        if done:
-          ep = {k: convert(v) for k, v in self._eps[i].items()}
-          [fn(ep.copy(), i, **self._kwargs) for fn in self._on_episodes]
-          episode += 1
+    workers = np.arange(len(self._env))
+    return self._process({**obs, **acts}, workers, step, episode)
+
+  def _process(self, trns, workers, step, episode):
+    self._lengths[workers[trns['is_first']]] = 0
+    self._record(trns, workers)
+    [fn(trns, workers, **self._kwargs) for fn in self._on_batches]
+    if self._on_steps:
+      for i, worker in enumerate(workers):
+        trn = {k: v[i] for k, v in trns.items()}
+        [fn(trn, int(worker), **self._kwargs) for fn in self._on_steps]
+    step += len(workers)
+    for worker in workers[trns['is_last']]:
+      length = self._lengths[worker]
+      ep = {k: v[worker, :length].copy() for k, v in self._eps.items()}
+      [fn(ep.copy(), int(worker), **self._kwargs) for fn in self._on_episodes]
+      episode += 1
     return step, episode
 
+  def _record(self, trns, workers):
+    # Episodes are written into preallocated arrays of shape [envs, capacity,
+    # ...] per key, so each step is one indexed write per key.
+    capacity = max([v.shape[1] for v in self._eps.values()] or [self._CAPACITY])
+    if self._lengths[workers].max() >= capacity:
+      capacity *= 2
+      for key, value in self._eps.items():
+        grown = np.zeros((len(value), capacity) + value.shape[2:], value.dtype)
+        grown[:, :value.shape[1]] = value
+        self._eps[key] = grown
+    for key, value in trns.items():
+      if key not in self._eps:
+        self._eps[key] = np.zeros(
+            (len(self._env), capacity) + value.shape[1:], value.dtype)
+    for key, value in self._eps.items():
+      # Keys that the policy did not return for this step stay zero.
+      value[workers, self._lengths[workers]] = trns.get(key, 0)
+    self._lengths[workers] += 1
+
   def _expand(self, value, dims):
     while len(value.shape) < dims:
       value = value[..., None]
     return value
+
+
+class AsyncDriver(Driver):
+
+  """Driver that steps some envs while the policy runs on others.
+
+  Actions are sent to the envs as soon as the policy computed them and the
+  policy runs on the first `batch` envs that return their observations, so
+  physics overlaps with inference and a slow env does not stall the others.
+  The policy state is kept per env and the rows of the envs in each batch are
+  gathered before and scattered back after the policy. Requires an env with
+  send and recv, such as BatchEnv."""
+
+  def __init__(self, env, batch=None, **kwargs):
+    assert hasattr(env, 'send') and hasattr(env, 'recv'), env
+    self._batch = batch or max(1, len(env) // 2)
+    assert 1 <= self._batch <= len(env), (self._batch, len(env))
+    super().__init__(env, **kwargs)
+
+  def reset(self):
+    if getattr(self, '_sent', False):
+      self._env.recv(len(self._env))  # Discard the steps still in flight.
+    super().reset()
+    self._sent = False
+
+  def _step(self, policy, step, episode):
+    if not self._sent:
+      acts = {k: v for k, v in self._acts.items() if not k.startswith('log_')}
+      self._env.send(acts, np.arange(len(self._env)))
+      self._sent = True
+    workers, obs = self._env.recv(self._batch)
+    obs = {k: convert(v) for k, v in obs.items()}
+    state = None
+    if self._state is not None:
+      state = treemap(lambda x: x[workers], self._state)
+    acts, state = policy(obs, state, **self._kwargs)
+    self._scatter(state, workers)
+    acts = {k: convert(v) for k, v in acts.items()}
+    if obs['is_last'].any():
+      mask = 1 - obs['is_last']
+      acts = {k: v * self._expand(mask, len(v.shape)) for k, v in acts.items()}
+    acts['reset'] = obs['is_last'].copy()
+    # The envs step while the transition is processed and the policy runs on
+    # the next batch.
+    self._env.send(
+        {k: v for k, v in acts.items() if not k.startswith('log_')}, workers)
+    return self._process({**obs, **acts}, workers, step, episode)
+
+  def _scatter(self, state, workers):
+    if state is None:
+      return
+    if self._state is None:
+      # Envs that have not been stepped yet start from zeros and reset their
+      # state on their first observation.
+      self._state = treemap(
+          lambda x: np.zeros((len(self._env),) + x.shape[1:], x.dtype), state)
+
+    def write(full, rows):
+      full[workers] = rows
+    treemap(write, self._state, state)
@@ -1,6 +1,8 @@
 import enum
 from functools import partial as bind
 
+import numpy as np
+
 from . import worker
 
 
@@ -27,6 +29,11 @@ class Parallel:
   def __len__(self):
     return self.worker(Message.CALL, '__len__')()
 
+  def share(self, buffers, index):
+    # Let the worker write its observations into row index of the shared
+    # buffers, given as {key: (name, shape, dtype)}, instead of returning them.
+    return self.worker(Message.SHARE, 'step', buffers, index)()
+
   def close(self):
     self.worker.close()
 
@@ -41,11 +48,40 @@ class Parallel:
     elif message == Message.READ:
       assert not args and not kwargs, (args, kwargs)
       result = getattr(state, name)
+    elif message == Message.SHARE:
+      state = SharedStep(state, *args, **kwargs)
+      result = True
     return state, result
 
 
+class SharedStep:
+
+  def __init__(self, env, buffers, index):
+    from multiprocessing import shared_memory
+    self.env = env
+    self.index = index
+    self.memory = {
+        k: shared_memory.SharedMemory(name=name)
+        for k, (name, _, _) in buffers.items()}
+    self.arrays = {
+        k: np.ndarray(shape, dtype, buffer=self.memory[k].buf)
+        for k, (_, shape, dtype) in buffers.items()}
+
+  def __getattr__(self, name):
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self.env, name)
+
+  def step(self, action):
+    obs = self.env.step(action)
+    for key, array in self.arrays.items():
+      array[self.index] = obs.pop(key)
+    return obs
+
+
 class Message(enum.Enum):
 
   CALLABLE = 2
   CALL = 3
   READ = 4
+  SHARE = 5
@@ -67,7 +67,7 @@ class ThreadWorker:
     future = self.executor.submit(self._worker, *args, **kwargs)
     self.futures.append(future)
     future.add_done_callback(lambda f: self.futures.remove(f))
-    return future.result
+    return Future(lambda _: future.result(), None, lambda _: future.done())
 
   def wait(self):
     concurrent.futures.wait(self.futures)
@@ -96,7 +96,7 @@ class ProcessWorker:
     future = self.executor.submit(self._worker, *args, **kwargs)
     self.futures.append(future)
     future.add_done_callback(lambda f: self.futures.remove(f))
-    return future.result
+    return Future(lambda _: future.result(), None, lambda _: future.done())
 
   def wait(self):
     concurrent.futures.wait(self.futures)
@@ -166,7 +166,10 @@ class ProcessPipeWorker:
     callid = self._nextid
     self._nextid += 1
     self._pipe.send((message, callid, payload))
-    return Future(self._receive, callid)
+    return Future(self._receive, callid, self._poll)
+
+  def _poll(self, callid):
+    return callid in self._results or self._pipe.poll()
 
   def _receive(self, callid):
     while callid not in self._results:
@@ -219,9 +222,10 @@ class ProcessPipeWorker:
 
 class Future:
 
-  def __init__(self, receive, callid):
+  def __init__(self, receive, callid, poll=None):
     self._receive = receive
     self._callid = callid
+    self._poll = poll
     self._result = None
     self._complete = False
 
@@ -231,6 +235,12 @@ class Future:
       self._complete = True
     return self._result
 
+  def done(self):
+    """Whether calling the future returns without blocking."""
+    if self._complete or self._poll is None:
+      return True
+    return self._poll(self._callid)
+
 
 class Message(enum.Enum):
 
@@ -1,6 +1,9 @@
 from .generic import Generic
 from .reverb import Reverb
 from .replays import Uniform
+from .replays import UniformRing
+from .replays import PrioritizedRing
+from .ring import Ring
 from .naive_chunks import NaiveChunks
 from . import selectors
 from . import limiters
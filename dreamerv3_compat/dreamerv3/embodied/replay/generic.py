@@ -7,6 +7,11 @@ import numpy as np
 
 from . import saver
 
+# Upper edges in seconds of the wait time histograms in the stats.
+WAIT_BINS = {
+    '100us': 1e-4, '1ms': 1e-3, '10ms': 1e-2, '100ms': 0.1, '1s': 1.0,
+    'inf': np.inf}
+
 
 class Generic:
 
@@ -37,6 +42,10 @@ class Generic:
         'insert_wait_dur': 0,
         'insert_wait_count': 0,
     }
+    self.wait_hists = {
+        'insert': np.zeros(len(WAIT_BINS), np.int64),
+        'sample': np.zeros(len(WAIT_BINS), np.int64),
+    }
     self.load()
 
   def __len__(self):
@@ -55,10 +64,23 @@ class Generic:
         'sample_wait_avg': ratio(m['sample_wait_dur'], m['samples']),
         'sample_wait_frac': ratio(m['sample_wait_count'], m['samples']),
     }
+    # Fraction of the operations that waited up to each bin edge.
+    for kind, hist in self.wait_hists.items():
+      total = m['inserts'] if kind == 'insert' else m['samples']
+      for name, count in zip(WAIT_BINS, np.cumsum(hist)):
+        stats[f'{kind}_wait_hist/{name}'] = ratio(count, total)
+      hist[:] = 0
     for key in self.metrics:
       self.metrics[key] = 0
     return stats
 
+  def _record_wait(self, kind, dur):
+    self.metrics[f'{kind}s'] += 1
+    self.metrics[f'{kind}_wait_dur'] += dur
+    self.metrics[f'{kind}_wait_count'] += int(dur > 0)
+    index = np.searchsorted(list(WAIT_BINS.values()), dur)
+    self.wait_hists[kind][index] += 1
+
   def add(self, step, worker=0, load=False):
     step = {k: v for k, v in step.items() if not k.startswith('log_')}
     step['id'] = np.asarray(embodied.uuid(step.get('id')))
@@ -81,20 +103,22 @@ class Generic:
       assert self.limiter.want_load()[0]
     else:
       dur = wait(self.limiter.want_insert, 'Replay insert is waiting')
-      self.metrics['inserts'] += 1
-      self.metrics['insert_wait_dur'] += dur
-      self.metrics['insert_wait_count'] += int(dur > 0)
+      self._record_wait('insert', dur)
     self.table[key] = seq
     self.remover[key] = seq
     self.sampler[key] = seq
     while self.capacity and len(self) > self.capacity:
       self._remove(self.remover())
 
+  def add_batch(self, steps, workers):
+    """Adds one step of every worker, given as arrays with the worker along
+    the first axis."""
+    for i, worker in enumerate(workers):
+      self.add({k: v[i] for k, v in steps.items()}, worker)
+
   def _sample(self):
     dur = wait(self.limiter.want_sample, 'Replay sample is waiting')
-    self.metrics['samples'] += 1
-    self.metrics['sample_wait_dur'] += dur
-    self.metrics['sample_wait_count'] += int(dur > 0)
+    self._record_wait('sample', dur)
     if self.online:
       try:
         seq = self.online_queue.popleft()
@@ -149,6 +173,11 @@ class Generic:
 
 
 def wait(predicate, message, sleep=0.001, notify=1.0):
+  # Limiters wake up the waiting thread when their state changes. Other
+  # predicates are polled.
+  limiter = getattr(predicate, '__self__', None)
+  if hasattr(limiter, 'changed'):
+    return limiter.wait(predicate, message, notify)
   start = time.time()
   notified = False
   while True:
@@ -1,22 +1,52 @@
 import threading
+import time
 
 
-class MinSize:
+class Limiter:
+
+  """Wakes up threads that wait for an operation whenever the state of the
+  limiter changes, instead of letting them poll the want methods."""
+
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.changed = threading.Condition(self.lock)
+
+  def wait(self, want, message, notify=1.0):
+    """Blocks until want allows the operation and returns the seconds spent
+    waiting. Prints the message once after waiting for notify seconds."""
+    with self.changed:
+      allowed, detail = want()
+      if allowed:
+        return 0.0
+      start = time.time()
+      notified = False
+      while not allowed:
+        # The timeout only serves the message, any change notifies.
+        if not self.changed.wait(notify) and not notified:
+          print(f'{message} ({detail})')
+          notified = True
+        allowed, detail = want()
+      return time.time() - start
+
+
+class MinSize(Limiter):
 
   def __init__(self, minimum):
     assert 1 <= minimum, minimum
+    super().__init__()
     self.minimum = minimum
     self.size = 0
-    self.lock = threading.Lock()
 
   def want_load(self):
     with self.lock:
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_insert(self):
     with self.lock:
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_remove(self):
@@ -24,6 +54,7 @@ class MinSize:
       if self.size < 1:
         return False, 'is empty'
       self.size -= 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_sample(self):
@@ -32,21 +63,22 @@ class MinSize:
     return True, 'ok'
 
 
-class SamplesPerInsert:
+class SamplesPerInsert(Limiter):
 
   def __init__(self, samples_per_insert, tolerance, minimum=1):
     assert 1 <= minimum
+    super().__init__()
     self.samples_per_insert = samples_per_insert
     self.minimum = minimum
     self.avail = -minimum
     self.min_avail = -tolerance
     self.max_avail = tolerance * samples_per_insert
     self.size = 0
-    self.lock = threading.Lock()
 
   def want_load(self):
     with self.lock:
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_insert(self):
@@ -55,6 +87,7 @@ class SamplesPerInsert:
         return False, f'rate limited: {self.avail:.3f} >= {self.max_avail:.3f}'
       self.avail += self.samples_per_insert
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_remove(self):
@@ -62,6 +95,7 @@ class SamplesPerInsert:
       if self.size < 1:
         return False, 'is empty'
       self.size -= 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_sample(self):
@@ -71,20 +105,22 @@ class SamplesPerInsert:
       if self.avail <= self.min_avail:
         return False, f'rate limited: {self.avail:.3f} <= {self.min_avail:.3f}'
       self.avail -= 1
+      self.changed.notify_all()
     return True, 'ok'
 
 
-class Queue:
+class Queue(Limiter):
 
   def __init__(self, capacity):
     assert 1 <= capacity
+    super().__init__()
     self.capacity = capacity
     self.size = 0
-    self.lock = threading.Lock()
 
   def want_load(self):
     with self.lock:
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_insert(self):
@@ -92,6 +128,7 @@ class Queue:
       if self.size >= self.capacity:
         return False, f'is full: {self.size} >= {self.capacity}'
       self.size += 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_remove(self):
@@ -99,6 +136,7 @@ class Queue:
       if self.size < 1:
         return False, 'is empty'
       self.size -= 1
+      self.changed.notify_all()
     return True, 'ok'
 
   def want_sample(self):
@@ -1,4 +1,5 @@
 from . import generic
+from . import ring
 from . import selectors
 from . import limiters
 
@@ -24,3 +25,48 @@ class Uniform(generic.Generic):
         online=online,
         chunks=chunks,
     )
+
+
+class UniformRing(ring.Ring):
+
+  def __init__(
+      self, length, capacity, directory=None, online=False, chunks=1024,
+      min_size=1, samples_per_insert=None, tolerance=1e4, seed=0):
+    if samples_per_insert:
+      limiter = limiters.SamplesPerInsert(
+          samples_per_insert, tolerance, min_size)
+    else:
+      limiter = limiters.MinSize(min_size)
+    assert min_size <= capacity
+    super().__init__(
+        length=length,
+        capacity=capacity,
+        sampler=selectors.Uniform(seed),
+        limiter=limiter,
+        directory=directory,
+        online=online,
+        chunks=chunks,
+    )
+
+
+class PrioritizedRing(ring.Ring):
+
+  def __init__(
+      self, length, capacity, directory=None, online=False, chunks=1024,
+      min_size=1, samples_per_insert=None, tolerance=1e4, seed=0,
+      exponent=1.0):
+    if samples_per_insert:
+      limiter = limiters.SamplesPerInsert(
+          samples_per_insert, tolerance, min_size)
+    else:
+      limiter = limiters.MinSize(min_size)
+    assert min_size <= capacity
+    super().__init__(
+        length=length,
+        capacity=capacity,
+        sampler=selectors.Prioritized(exponent, seed=seed, capacity=capacity),
+        limiter=limiter,
+        directory=directory,
+        online=online,
+        chunks=chunks,
+    )
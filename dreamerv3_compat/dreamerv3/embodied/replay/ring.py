@@ -0,0 +1,174 @@
+import threading
+
+import embodied
+import numpy as np
+
+from . import generic
+
+
+class Ring(generic.Generic):
+
+  """Replay that writes steps into preallocated arrays per key.
+
+  Steps of all workers share one ring of `capacity` slots and every worker
+  only tracks the slots of its ongoing sequence. A sequence is stored as the
+  array of its slots and is removed once its first slot gets overwritten, so
+  sampling is a single gather per key instead of rebuilding the sequence from
+  per-step dicts."""
+
+  def __init__(
+      self, length, capacity, sampler, limiter, directory, online=False,
+      chunks=1024):
+    assert capacity and length <= capacity, (length, capacity)
+    self.size = int(capacity)
+    self.data = {}
+    self.stamps = np.full(self.size, -1, np.int64)
+    self.starts = np.zeros(self.size, bool)
+    self.pointer = 0
+    self.written = 0
+    self.lock = threading.RLock()
+    super().__init__(
+        length=length,
+        capacity=None,
+        remover=None,
+        sampler=sampler,
+        limiter=limiter,
+        directory=directory,
+        online=online,
+        chunks=chunks,
+    )
+
+  def add(self, step, worker=0, load=False):
+    step = {k: v for k, v in step.items() if not k.startswith('log_')}
+    step['id'] = np.asarray(embodied.uuid(step.get('id')))
+    with self.lock:
+      if not self.data:
+        self._allocate(step)
+      slot = self.pointer
+      if self.starts[slot]:
+        self._remove(slot)
+      for key, value in step.items():
+        self.data[key][slot] = value
+      self.stamps[slot] = self.written
+      self.pointer = (slot + 1) % self.size
+      self.streams[worker].append((slot, self.written))
+      self.written += 1
+    self.saver and self.saver.add(step, worker)
+    self._insert(worker, load)
+
+  def add_batch(self, steps, workers):
+    """Adds one step of every worker, given as arrays with the worker along
+    the first axis, with a single write per key."""
+    steps = {k: v for k, v in steps.items() if not k.startswith('log_')}
+    count = len(workers)
+    assert count <= self.size, (count, self.size)
+    ids = steps.get('id', [None] * count)
+    steps['id'] = np.stack([np.asarray(embodied.uuid(x)) for x in ids])
+    with self.lock:
+      if not self.data:
+        self._allocate({k: v[0] for k, v in steps.items()})
+      slots = (self.pointer + np.arange(count)) % self.size
+      for slot in slots[self.starts[slots]]:
+        self._remove(slot)
+      for key, value in steps.items():
+        self.data[key][slots] = value
+      stamps = self.written + np.arange(count)
+      self.stamps[slots] = stamps
+      self.pointer = (self.pointer + count) % self.size
+      self.written += count
+      for worker, slot, stamp in zip(workers, slots, stamps):
+        self.streams[worker].append((int(slot), int(stamp)))
+    for i, worker in enumerate(workers):
+      if self.saver:
+        self.saver.add({k: v[i] for k, v in steps.items()}, worker)
+      self._insert(worker)
+
+  def _insert(self, worker, load=False):
+    stream = self.streams[worker]
+    if self.online:
+      self.online_counters[worker] += 1
+    if len(stream) < self.length:
+      return
+    # The oldest slot of the stream is overwritten first, so the sequence is
+    # intact as long as that slot still holds the same step.
+    start, stamp = stream[0]
+    if self.stamps[start] != stamp:
+      return
+    seq = np.array([slot for slot, _ in stream])
+    if self.online and self.online_counters[worker] >= self.online_stride:
+      self.online_queue.append((seq, stamp))
+      self.online_counters[worker] = 0
+    if load:
+      assert self.limiter.want_load()[0]
+    else:
+      dur = generic.wait(self.limiter.want_insert, 'Replay insert is waiting')
+      self._record_wait('insert', dur)
+    with self.lock:
+      if self.stamps[start] != stamp:
+        return
+      self.table[start] = seq
+      self.starts[start] = True
+      self.sampler[start] = seq
+
+  def _allocate(self, step):
+    for key, value in step.items():
+      value = embodied.convert(value)
+      self.data[key] = np.zeros((self.size,) + value.shape, value.dtype)
+
+  def _sample(self):
+    return {k: v[0] for k, v in self.sample_batch(1).items()}
+
+  def sample_batch(self, batch_size):
+    for _ in range(batch_size):
+      dur = generic.wait(self.limiter.want_sample, 'Replay sample is waiting')
+      self._record_wait('sample', dur)
+    with self.lock:
+      seqs = []
+      while self.online and self.online_queue and len(seqs) < batch_size:
+        seq, stamp = self.online_queue.popleft()
+        if self.stamps[seq[0]] == stamp:
+          seqs.append(seq)
+      count = batch_size - len(seqs)
+      if hasattr(self.sampler, 'sample'):
+        keys = self.sampler.sample(count)
+      else:
+        keys = [self.sampler() for _ in range(count)]
+      seqs += [self.table[key] for key in keys]
+      # Gather the [B, T] slots of every key at once into a new batch array.
+      index = np.stack(seqs)
+      batch = {k: v[index] for k, v in self.data.items()}
+      if hasattr(self.sampler, 'prioritize'):
+        # Sequences are keyed by their first slot and its stamp, so the train
+        # step can send back a priority for every sequence of the batch and
+        # priorities of sequences that were overwritten since are dropped.
+        batch['key'] = np.stack([index[:, 0], self.stamps[index[:, 0]]], -1)
+    if 'is_first' in batch:
+      batch['is_first'][:, 0] = True
+    return batch
+
+  def prioritize(self, keys, prios):
+    if not hasattr(self.sampler, 'prioritize'):
+      return
+    keys = np.asarray(keys).reshape((-1, 2))
+    prios = np.asarray(prios).ravel()
+    # The actor thread adds to the sampler under the lock at the same time.
+    with self.lock:
+      slots, stamps = keys[:, 0], keys[:, 1]
+      valid = self.starts[slots] & (self.stamps[slots] == stamps)
+      self.sampler.prioritize(slots[valid].tolist(), prios[valid])
+
+  def _remove(self, key):
+    generic.wait(self.limiter.want_remove, 'Replay remove is waiting')
+    del self.table[key]
+    del self.sampler[key]
+    self.starts[key] = False
+
+  def load(self, data=None):
+    if not self.saver:
+      return
+    workers = set()
+    for step, worker in self.saver.load(self.size, self.length):
+      workers.add(worker)
+      self.add(step, worker, load=True)
+    for worker in workers:
+      del self.streams[worker]
@@ -1,25 +1,34 @@
-from collections import deque
-
 import numpy as np
 
 
 class Fifo:
 
+  """Removes keys in the order they were added. Keys live in a list that
+  removals only mark, so removing any key takes O(1) and the list is compacted
+  once most of it is marked."""
+
+  REMOVED = object()
+
   def __init__(self):
-    self.queue = deque()
+    self.keys = []
+    self.indices = {}
+    self.head = 0
 
   def __call__(self):
-    return self.queue[0]
+    return self.keys[self.head]
 
   def __setitem__(self, key, steps):
-    self.queue.append(key)
+    self.indices[key] = len(self.keys)
+    self.keys.append(key)
 
   def __delitem__(self, key):
-    if self.queue[0] == key:
-      self.queue.popleft()
-    else:
-      # TODO: This branch is unused but very slow.
-      self.queue.remove(key)
+    self.keys[self.indices.pop(key)] = self.REMOVED
+    while self.head < len(self.keys) and self.keys[self.head] is self.REMOVED:
+      self.head += 1
+    if len(self.keys) > 2 * len(self.indices) + 1024:
+      self.keys = [k for k in self.keys[self.head:] if k is not self.REMOVED]
+      self.indices = {k: i for i, k in enumerate(self.keys)}
+      self.head = 0
 
 
 class Uniform:
@@ -33,6 +42,10 @@ class Uniform:
     index = self.rng.integers(0, len(self.keys)).item()
     return self.keys[index]
 
+  def sample(self, count):
+    indices = self.rng.integers(0, len(self.keys), count)
+    return [self.keys[index] for index in indices]
+
   def __setitem__(self, key, steps):
     self.indices[key] = len(self.keys)
     self.keys.append(key)
@@ -43,3 +56,101 @@ class Uniform:
     if index != len(self.keys):
       self.keys[index] = last
       self.indices[last] = index
+
+
+class Prioritized:
+
+  """Samples keys proportionally to their priority to the power of exponent.
+
+  The priorities are the leaves of a sum tree, so sampling and updating a key
+  take O(log n) and batches of them are vectorized over the levels of the
+  tree. New keys start with the largest priority seen so far, so they are
+  sampled soon after they were added. The tree doubles when it is full."""
+
+  def __init__(self, exponent=1.0, initial=1.0, seed=0, capacity=1024):
+    assert exponent >= 0, exponent
+    self.exponent = exponent
+    self.maximum = initial
+    self.rng = np.random.default_rng(seed)
+    self.size = 1 << max(0, int(capacity) - 1).bit_length()
+    # Node i has the children 2i and 2i + 1 and leaf j is node size + j.
+    self.tree = np.zeros(2 * self.size, np.float64)
+    self.keys = [None] * self.size
+    self.leaves = {}
+    self.free = list(range(self.size - 1, -1, -1))
+
+  def __len__(self):
+    return len(self.leaves)
+
+  def __call__(self):
+    return self.sample(1)[0]
+
+  def sample(self, count):
+    assert self.leaves, 'Cannot sample from an empty selector.'
+    leaves = self._find(self.rng.uniform(0, self.tree[1], count))
+    # Rounding can end up in a leaf without priority, draw those again.
+    empty = self.tree[self.size + leaves] == 0
+    while empty.any():
+      leaves[empty] = self._find(self.rng.uniform(0, self.tree[1], empty.sum()))
+      empty = self.tree[self.size + leaves] == 0
+    return [self.keys[leaf] for leaf in leaves]
+
+  def __setitem__(self, key, steps):
+    if not self.free:
+      self._grow()
+    leaf = self.free.pop()
+    self.leaves[key] = leaf
+    self.keys[leaf] = key
+    self._update_one(leaf, self.maximum ** self.exponent)
+
+  def __delitem__(self, key):
+    leaf = self.leaves.pop(key)
+    self.keys[leaf] = None
+    self.free.append(leaf)
+    self._update_one(leaf, 0.0)
+
+  def prioritize(self, keys, priorities):
+    """Sets the priorities of keys. Keys that were removed in the meantime
+    are skipped."""
+    priorities = np.maximum(np.asarray(priorities, np.float64).ravel(), 1e-6)
+    pairs = [
+        (self.leaves[key], prio) for key, prio in zip(keys, priorities)
+        if key in self.leaves]
+    if not pairs:
+      return
+    leaves, values = map(np.array, zip(*pairs))
+    self.maximum = max(self.maximum, float(values.max()))
+    self.tree[self.size + leaves] = values ** self.exponent
+    self._update_parents(self.size + leaves)
+
+  def _find(self, targets):
+    nodes = np.ones(len(targets), np.int64)
+    while nodes[0] < self.size:
+      left = self.tree[2 * nodes]
+      right = targets >= left
+      targets = np.where(right, targets - left, targets)
+      nodes = 2 * nodes + right
+    return nodes - self.size
+
+  def _update_one(self, leaf, value):
+    node = self.size + leaf
+    self.tree[node] = value
+    node //= 2
+    while node:
+      self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+      node //= 2
+
+  def _update_parents(self, nodes):
+    nodes = np.unique(nodes // 2)
+    while nodes[0] >= 1:
+      self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+      nodes = np.unique(nodes // 2)
+
+  def _grow(self):
+    size = self.size
+    tree = np.zeros(4 * size, np.float64)
+    tree[2 * size: 3 * size] = self.tree[size:]
+    self.size, self.tree = 2 * size, tree
+    self.keys += [None] * size
+    self.free = list(range(2 * size - 1, size - 1, -1))
+    self._update_parents(np.arange(2 * size, 4 * size))
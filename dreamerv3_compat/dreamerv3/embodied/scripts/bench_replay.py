@@ -0,0 +1,78 @@
+import argparse
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.parent))
+import embodied
+
+
+REPLAYS = {
+    'uniform': embodied.replay.Uniform,
+    'ring': embodied.replay.UniformRing,
+}
+
+
+def make_step(rng, args, index):
+  step = {
+      'obs': rng.normal(size=(args.obs,)).astype(np.float32),
+      'context': rng.normal(size=(8,)).astype(np.float32),
+      'action': rng.uniform(-1, 1, (args.act,)).astype(np.float32),
+      'reward': np.float32(rng.normal()),
+      'is_first': index % 1000 == 0,
+      'is_last': index % 1000 == 999,
+      'is_terminal': False,
+  }
+  if args.image:
+    step['image'] = rng.integers(0, 255, (64, 64, 3), np.uint8)
+  return step
+
+
+def bench(name, args):
+  rng = np.random.default_rng(0)
+  replay = REPLAYS[name](args.length, args.capacity)
+  steps = [make_step(rng, args, i) for i in range(1000)]
+  start = time.time()
+  for index in range(args.inserts):
+    replay.add(steps[index % len(steps)], worker=index % args.workers)
+  insert = args.inserts / (time.time() - start)
+  dataset = replay.dataset()
+  next(dataset)
+  start = time.time()
+  for _ in range(args.samples):
+    next(dataset)
+  sample = args.samples / (time.time() - start)
+  line = (
+      f'{name:>8}: {insert:10.0f} inserts/s {sample:10.0f} samples/s '
+      f'{sample * args.length:12.0f} steps/s')
+  if hasattr(replay, 'sample_batch'):
+    batches = max(1, args.samples // args.batch)
+    start = time.time()
+    for _ in range(batches):
+      replay.sample_batch(args.batch)
+    batched = batches * args.batch / (time.time() - start)
+    line += f' {batched:10.0f} samples/s batched'
+  print(line)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--replays', nargs='+', default=list(REPLAYS))
+  parser.add_argument('--length', type=int, default=64)
+  parser.add_argument('--capacity', type=int, default=100000)
+  parser.add_argument('--inserts', type=int, default=50000)
+  parser.add_argument('--samples', type=int, default=2000)
+  parser.add_argument('--batch', type=int, default=16)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--obs', type=int, default=17)
+  parser.add_argument('--act', type=int, default=6)
+  parser.add_argument('--image', action='store_true')
+  args = parser.parse_args()
+  for name in args.replays:
+    bench(name, args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent.parent))
+
+import embodied
+import numpy as np
+from embodied.replay import selectors
+
+
+def check_tree(selector):
+  tree, size = selector.tree, selector.size
+  assert np.allclose(tree[1:size], tree[2:2 * size:2] + tree[3:2 * size:2])
+
+
+class TestFifo:
+
+  def test_order(self):
+    fifo = selectors.Fifo()
+    for key in range(5):
+      fifo[key] = None
+    for key in range(5):
+      assert fifo() == key
+      del fifo[key]
+
+  def test_remove_middle(self):
+    fifo = selectors.Fifo()
+    for key in range(10):
+      fifo[key] = None
+    del fifo[3]
+    del fifo[5]
+    assert fifo() == 0
+    del fifo[0]
+    assert fifo() == 1
+    del fifo[1]
+    del fifo[2]
+    assert fifo() == 4
+    del fifo[4]
+    assert fifo() == 6
+    fifo[3] = None
+    for key in range(6, 10):
+      del fifo[key]
+    assert fifo() == 3
+
+  def test_compaction(self):
+    fifo = selectors.Fifo()
+    keys = list(range(5000))
+    for key in keys:
+      fifo[key] = None
+    rng = np.random.default_rng(0)
+    removed = rng.permutation(keys)[:4900]
+    for key in removed:
+      del fifo[int(key)]
+    remaining = sorted(set(keys) - set(removed.tolist()))
+    assert len(fifo.keys) < 5000
+    for key in remaining:
+      assert fifo() == key
+      del fifo[key]
+    assert not fifo.indices
+
+
+class TestPrioritized:
+
+  def test_frequencies(self):
+    selector = selectors.Prioritized(seed=0)
+    prios = np.array([1.0, 2.0, 3.0, 4.0])
+    for key in range(len(prios)):
+      selector[key] = None
+    selector.prioritize(list(range(len(prios))), prios)
+    counts = np.bincount(selector.sample(40000), minlength=len(prios))
+    assert np.allclose(counts / counts.sum(), prios / prios.sum(), atol=0.01)
+
+  def test_exponent(self):
+    selector = selectors.Prioritized(exponent=2.0, seed=0)
+    selector['a'] = None
+    selector['b'] = None
+    selector.prioritize(['a', 'b'], [1.0, 3.0])
+    samples = selector.sample(20000)
+    assert abs(samples.count('b') / len(samples) - 0.9) < 0.01
+
+  def test_new_keys_get_maximum(self):
+    selector = selectors.Prioritized(seed=0)
+    selector[0] = None
+    selector.prioritize([0], [5.0])
+    selector[1] = None
+    leaves = [selector.leaves[key] for key in (0, 1)]
+    assert np.allclose(selector.tree[selector.size + np.array(leaves)], 5.0)
+
+  def test_removed_keys_are_not_sampled(self):
+    selector = selectors.Prioritized(seed=0, capacity=8)
+    for key in range(8):
+      selector[key] = None
+    for key in (0, 3, 7):
+      del selector[key]
+    selector.prioritize([3, 4], [10.0, 2.0])
+    check_tree(selector)
+    assert set(selector.sample(5000)) == {1, 2, 4, 5, 6}
+
+  def test_grow(self):
+    selector = selectors.Prioritized(seed=0, capacity=4)
+    prios = {key: float(key + 1) for key in range(4)}
+    for key in prios:
+      selector[key] = None
+    selector.prioritize(list(prios), list(prios.values()))
+    del selector[1]
+    del prios[1]
+    total = selector.tree[1]
+    assert np.isclose(total, sum(prios.values()))
+    for key in range(4, 11):
+      selector[key] = None
+      prios[key] = selector.maximum
+    assert selector.size == 16
+    check_tree(selector)
+    assert np.isclose(selector.tree[1], sum(prios.values()))
+    for key, prio in prios.items():
+      assert selector.keys[selector.leaves[key]] == key
+      assert np.isclose(selector.tree[selector.size + selector.leaves[key]], prio)
+    assert set(selector.sample(5000)) == set(prios)
+
+
+class TestPrioritizedRing:
+
+  def _add(self, replay, count, start=0):
+    for index in range(start, start + count):
+      replay.add({'obs': np.float32(index), 'is_first': index == 0})
+
+  def test_keys_and_priorities(self):
+    replay = embodied.replay.PrioritizedRing(length=2, capacity=8)
+    self._add(replay, 6)
+    batch = replay.sample_batch(4)
+    slots, stamps = batch['key'][:, 0], batch['key'][:, 1]
+    assert (batch['obs'][:, 0] == stamps).all()
+    assert (replay.stamps[slots] == stamps).all()
+    replay.prioritize(batch['key'][:1], [100.0])
+    slot = int(slots[0])
+    leaf = replay.sampler.leaves[slot]
+    assert replay.sampler.tree[replay.sampler.size + leaf] == 100.0
+
+  def test_stale_keys_are_ignored(self):
+    replay = embodied.replay.PrioritizedRing(length=2, capacity=4)
+    self._add(replay, 4)
+    stale = replay.sample_batch(8)['key']
+    # Overwrite every slot, so the sequences start at the same slots again
+    # but with newer stamps.
+    self._add(replay, 4, start=4)
+    selector = replay.sampler
+    before = selector.tree.copy()
+    replay.prioritize(stale, np.full(len(stale), 100.0))
+    assert np.array_equal(selector.tree, before)
+    assert selector.maximum == 1.0
+    fresh = replay.sample_batch(8)['key']
+    assert (fresh[:, 1] >= 4).all()
+    replay.prioritize(fresh[:1], [100.0])
+    assert selector.maximum == 100.0
@@ -1,4 +1,10 @@
+import collections
 import os
+import queue as queuelib
+import sys
+import threading
+import time
+import traceback
 
 import embodied
 import jax
@@ -11,6 +17,8 @@ from . import ninjax as nj
 tree_map = jax.tree_util.tree_map
 tree_flatten = jax.tree_util.tree_flatten
 
+COMPILE_CACHE = collections.Counter()
+
 
 def Wrapper(agent_cls):
   class Agent(JAXAgent):
@@ -51,6 +59,8 @@ class JAXAgent(embodied.Agent):
     self._transform()
     self.varibs = self._init_varibs(obs_space, act_space)
     self.sync()
+    if getattr(self.config, 'compilation_cache_dir', ''):
+      print('Compilation cache:', dict(COMPILE_CACHE))
 
   def policy(self, obs, state=None, mode='train'):
     obs = obs.copy()
@@ -86,6 +96,8 @@ class JAXAgent(embodied.Agent):
       assert jaxutils.Optimizer.PARAM_COUNTS
       for name, count in jaxutils.Optimizer.PARAM_COUNTS.items():
         mets[f'params_{name}'] = float(count)
+      for name, count in COMPILE_CACHE.items():
+        mets[f'compile_cache_{name}'] = float(count)
     return outs, state, mets
 
   def report(self, data):
@@ -95,12 +107,22 @@ class JAXAgent(embodied.Agent):
     return mets
 
   def dataset(self, generator):
-    batcher = embodied.Batcher(
-        sources=[generator] * self.batch_size,
-        workers=self.data_loaders,
-        postprocess=lambda x: self._convert_inps(x, self.train_devices),
-        prefetch_source=4, prefetch_batch=1)
-    return batcher()
+    replay = getattr(generator, '__self__', None)
+    if hasattr(replay, 'sample_batch'):
+      # The replay gathers whole batches itself, so a single source is enough
+      # and there is nothing left to stack.
+      source = lambda: iter(lambda: replay.sample_batch(self.batch_size), None)
+      batcher = embodied.Batcher(
+          sources=[source],
+          workers=min(self.data_loaders, 1),
+          prefetch_source=4, prefetch_batch=1, stack=False)
+    else:
+      batcher = embodied.Batcher(
+          sources=[generator] * self.batch_size,
+          workers=self.data_loaders,
+          prefetch_source=4, prefetch_batch=1)
+    convert = lambda x: self._convert_inps(x, self.train_devices)
+    return Prefetcher(batcher(), convert, getattr(self.config, 'prefetch', 1))
 
   def save(self):
     if len(self.train_devices) > 1:
@@ -154,6 +176,12 @@ class JAXAgent(embodied.Agent):
     if self.config.platform == 'cpu':
       jax.config.update('jax_disable_most_optimizations', self.config.debug)
     jaxutils.COMPUTE_DTYPE = getattr(jnp, self.config.precision)
+    cache_dir = getattr(self.config, 'compilation_cache_dir', '')
+    if cache_dir:
+      jax.config.update('jax_compilation_cache_dir', str(cache_dir))
+      # Also keep the quick policy compiles, a full run compiles only a few.
+      jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+      _count_compile_cache()
 
   def _transform(self):
     self._init_policy = nj.pure(lambda x: self.agent.policy_initial(len(x)))
@@ -242,3 +270,70 @@ class JAXAgent(embodied.Agent):
     for dim in reversed(batch_dims):
       data = {k: np.repeat(v[None], dim, axis=0) for k, v in data.items()}
     return data
+
+
+def _count_compile_cache():
+  # Counts hits and misses of the persistent cache into COMPILE_CACHE.
+  if 'misses' in COMPILE_CACHE:
+    return  # Already registered by an earlier agent.
+  COMPILE_CACHE.update(hits=0, misses=0)
+  events = {
+      '/jax/compilation_cache/cache_hits': 'hits',
+      '/jax/compilation_cache/cache_misses': 'misses',
+  }
+  def listener(event, **kwargs):
+    if event in events:
+      COMPILE_CACHE[events[event]] += 1
+  jax.monitoring.register_event_listener(listener)
+
+
+class Prefetcher:
+
+  """Keeps the next batches resident on the train devices. A thread moves
+  the host batches to the devices and waits for the copies to finish, so
+  the learner only blocks when the data pipeline falls behind."""
+
+  def __init__(self, source, convert, amount=1):
+    assert 1 <= amount, amount
+    self._source = source
+    self._convert = convert
+    self._queue = queuelib.Queue(amount)
+    self._lock = threading.Lock()
+    self._waits = []
+    self._thread = threading.Thread(target=self._worker, daemon=True)
+    self._thread.start()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    start = time.perf_counter()
+    batch = self._queue.get()
+    with self._lock:
+      self._waits.append(time.perf_counter() - start)
+    if isinstance(batch, Exception):
+      raise batch
+    return batch
+
+  def stats(self):
+    with self._lock:
+      waits, self._waits = np.array(self._waits), []
+    if not len(waits):
+      return {}
+    return {
+        'wait_avg': waits.mean(),
+        'wait_max': waits.max(),
+        'wait_frac': (waits > 1e-3).mean(),  # Blocked for over a millisecond.
+        'ready': self._queue.qsize(),
+    }
+
+  def _worker(self):
+    try:
+      while True:
+        batch = self._convert(next(self._source))
+        jax.block_until_ready(batch)
+        self._queue.put(batch)  # Will wait here if the queue is full.
+    except Exception as e:
+      e.stacktrace = ''.join(traceback.format_exception(*sys.exc_info()))
+      self._queue.put(e)
+      raise
@@ -29,6 +29,8 @@ class CtxEncoder(nj.Module):
 
         self._input_permutation = input_permutation
         self.network_type = network_type
+        # A causal encoder emits one context per timestep from its prefix.
+        self.causal = network_type == "causal_transformer"
 
         kw["linear_ctx_out"]["units"] = kw["linear_ctx_out"].pop("hunits")
         self._kw = kw
@@ -49,7 +51,7 @@ class CtxEncoder(nj.Module):
         self.inv_opts["units"] = self.inv_opts.pop("hunits")
         self.rssm_config = kw["rssm_config"]
 
-    def __call__(self, inputs):
+    def __call__(self, inputs, window=None, return_all=False):
         # Extract inputs for the context encoding
         feat = self._inputs(inputs)
         if self._symlog_inputs:
@@ -67,14 +69,15 @@ class CtxEncoder(nj.Module):
                 x = self.get(f'ctx_linear{i}', Linear, **mlp_opts)(x)
         elif self.network_type == "gru":
             x = self.get('gru_lin_in', Linear, **self.gru_opts["linear"])(x)
-            current_state = jnp.zeros([batch_size, self.gru_opts["units"]], f32)
-            hidden_states = []
-            for t in range(batch_len):
-                current_state, _ = self._gru(x[:, t], current_state)
-                hidden_states.append(current_state)
-            hidden_history = jnp.stack(hidden_states, axis=0)
-            final_state = hidden_history[-1]
-            x = self.get('gru_lin_out', Linear, **self.gru_opts["linear"])(final_state)
+            start = jnp.zeros([batch_size, self.gru_opts["units"]], f32)
+            step = lambda deter, x: self._gru(x, deter)[0]
+            hidden_history = jaxutils.scan(step, x.transpose([1, 0, 2]), start, unroll=False)
+            if return_all:
+                # The hidden state after step t summarizes the prefix [0, t].
+                x = self.get('gru_lin_out', Linear, **self.gru_opts["linear"])(
+                    hidden_history.transpose([1, 0, 2]))
+                return self.get('ctx_out', Linear, **self._kw["linear_ctx_out"])(x)
+            x = self.get('gru_lin_out', Linear, **self.gru_opts["linear"])(hidden_history[-1])
         elif self.network_type == "attention":
             # x = x.reshape([batch_size, -1])
             x = self.get('proj', Linear, **self.attn_opts["linear"])(x)
@@ -96,10 +99,85 @@ class CtxEncoder(nj.Module):
             x = self.get('ff2', Linear, **self.attn_opts["linear"])(x)
             x += skip
             x = x.reshape([batch_size, -1])
+        elif self.network_type == "causal_transformer":
+            # Same block as above, but every step only attends to itself and
+            # the previous steps (at most window of them), so a single pass
+            # yields the context of every prefix of the sequence.
+            pos = jnp.arange(batch_len)
+            mask = pos[None, :] <= pos[:, None]
+            if window is not None:
+                mask &= pos[None, :] > pos[:, None] - window
+            x = self.get('proj', Linear, **self.attn_opts["linear"])(x)
+            skip = x
+            x = self.get("norm1", Norm, "layer")(x)
+            x = self.get('attn', Attention, self.attn_opts["heads"], self.attn_opts["units"])(
+                x, x, x, mask=mask[None, None])
+            x += skip
+            skip = x
+            x = self.get("norm2", Norm, "layer")(x)
+            x = self.get('ff1', Linear, **self.attn_opts["linear"])(x)
+            x = self.get('ff2', Linear, **self.attn_opts["linear"])(x)
+            x += skip
+            return self.get('ctx_out', Linear, **self._kw["linear_ctx_out"])(x)
 
         ctx_out = self.get('ctx_out', Linear, **self._kw["linear_ctx_out"])(x)
         return jnp.broadcast_to(ctx_out[:, None, :], (batch_size, batch_len, ctx_out.shape[-1]))
 
+    def initial(self, batch_size, length):
+        if self.network_type == "gru":
+            return {"deter": jnp.zeros([batch_size, self.gru_opts["units"]], f32)}
+        elif self.causal:
+            shape = (batch_size, length, self.attn_opts["heads"], self.attn_opts["units"])
+            return {
+                "key": cast(jnp.zeros(shape, f32)),
+                "value": cast(jnp.zeros(shape, f32)),
+                "index": jnp.zeros(batch_size, jnp.int32),
+                "count": jnp.zeros(batch_size, jnp.int32),
+            }
+        else:
+            raise NotImplementedError(self.network_type)
+
+    def step(self, carry, inputs):
+        # Encode only the newest step of every sequence. The causal transformer
+        # keeps the keys and values of the last steps in a ring buffer, the gru
+        # carries its hidden state, so the cost per step does not grow with the
+        # window length.
+        feat = self._inputs(inputs)
+        if self._symlog_inputs:
+            feat = jaxutils.symlog(feat)
+        x = jaxutils.cast_to_compute(feat)
+
+        if self.network_type == "gru":
+            x = self.get('gru_lin_in', Linear, **self.gru_opts["linear"])(x)
+            deter, _ = self._gru(x, carry["deter"])
+            x = self.get('gru_lin_out', Linear, **self.gru_opts["linear"])(deter)
+            carry = {"deter": deter}
+        elif self.causal:
+            rows = jnp.arange(len(x))
+            index, length = carry["index"], carry["key"].shape[1]
+            count = jnp.minimum(carry["count"] + 1, length)
+            x = self.get('proj', Linear, **self.attn_opts["linear"])(x)
+            skip = x
+            x = self.get("norm1", Norm, "layer")(x)
+            attn = self.get('attn', Attention, self.attn_opts["heads"], self.attn_opts["units"])
+            query, key, value = attn.project(x, x, x)
+            keys = carry["key"].at[rows, index].set(key)
+            values = carry["value"].at[rows, index].set(value)
+            mask = jnp.arange(length)[None] < count[:, None]
+            x = attn.attend(query[:, None], keys, values, mask=mask[:, None, None])[:, 0]
+            x += skip
+            skip = x
+            x = self.get("norm2", Norm, "layer")(x)
+            x = self.get('ff1', Linear, **self.attn_opts["linear"])(x)
+            x = self.get('ff2', Linear, **self.attn_opts["linear"])(x)
+            x += skip
+            carry = {"key": keys, "value": values, "index": (index + 1) % length, "count": count}
+        else:
+            raise NotImplementedError(self.network_type)
+
+        ctx_out = self.get('ctx_out', Linear, **self._kw["linear_ctx_out"])(x)
+        return ctx_out, carry
+
     def reconstruct_wm_state_loss(self, ctx, wm_state):
         kw = {'act': 'none', 'units': self.rssm_config["stoch"] * self.rssm_config["classes"]}
         recon_wm_state = self.get('recon_wm', Linear, **kw)(ctx)
@@ -152,7 +230,7 @@ class CtxEncoder(nj.Module):
         action_pred = self.get('inverse_out', Linear, action.shape[-1], act="none")(x)
         return action_pred
 
-    def compute_loss(self, inputs):
+    def compute_loss(self, inputs, reduce=True):
         use_fw = self._kw["representation_loss"] == "fw"
         use_inv = self._kw["representation_loss"] == "inv"
 
@@ -184,7 +262,7 @@ class CtxEncoder(nj.Module):
                 "context": context,
             })
             loss += ((action_pred - action[:, 1:]) ** 2).mean(-1)
-        return loss.mean(-1)
+        return loss.mean(-1) if reduce else loss
 
 class Attention(nj.Module):
     def __init__(self, heads, size, winit="normal", fan="avg"):
@@ -193,10 +271,16 @@ class Attention(nj.Module):
         self.kw = dict(winit=winit, fan=fan)
 
     def __call__(self, query, key, value, mask=None):
+        return self.attend(*self.project(query, key, value), mask=mask)
+
+    def project(self, query, key, value):
         shape = (self.heads, self.size)
         query = self.get("query", Linear, shape, **self.kw)(query)
         key = self.get("key", Linear, shape, **self.kw)(key)
         value = self.get("value", Linear, shape, **self.kw)(value)
+        return query, key, value
+
+    def attend(self, query, key, value, mask=None):
         logits = jnp.einsum("...thd,...Thd->...htT", query, key)
         logits /= np.sqrt(self.size).astype(key.dtype)
         if mask is not None:
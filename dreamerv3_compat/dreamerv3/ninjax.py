@@ -290,6 +290,18 @@ def scan(fun, carry, xs, reverse=False, unroll=1, modify=False):
   return carry, ys
 
 
+@jax.named_scope('vmap')
+def vmap(fun, *xs):
+  """Map fun over the leading axis of xs. Every call gets its own RNG key
+  and reads the state like scan(), so the calls cannot modify it."""
+  fun = pure(fun, nested=True)
+  _prerun(fun, *jax.tree_util.tree_map(lambda x: x[0], xs))
+  length = len(jax.tree_util.tree_leaves(xs)[0])
+  state = dict(context())
+  inner = lambda rng, *xs: fun(state, rng, *xs, create=False, modify=False)[0]
+  return jax.vmap(inner)(rng(length), *xs)
+
+
 @jax.named_scope('_prerun')
 def _prerun(fun, *args, **kwargs):
   if not context().create:
@@ -120,16 +120,19 @@ def make_logger(parsed, logdir, step, config):
 
 def make_replay(
     config, directory=None, is_eval=False, rate_limit=False, **kwargs):
-  assert config.replay == 'uniform' or not rate_limit
+  assert config.replay in ('uniform', 'ring') or not rate_limit
   length = config.batch_length
   size = config.replay_size // 10 if is_eval else config.replay_size
-  if config.replay == 'uniform' or is_eval:
+  if config.replay in ('uniform', 'ring') or is_eval:
     kw = {'online': config.replay_online}
     if rate_limit and config.run.train_ratio > 0:
       kw['samples_per_insert'] = config.run.train_ratio / config.batch_length
       kw['tolerance'] = 10 * config.batch_size
       kw['min_size'] = config.batch_size
-    replay = embodied.replay.Uniform(length, size, directory, **kw)
+    if config.replay == 'ring':
+      replay = embodied.replay.UniformRing(length, size, directory, **kw)
+    else:
+      replay = embodied.replay.Uniform(length, size, directory, **kw)
   elif config.replay == 'reverb':
     replay = embodied.replay.Reverb(length, size, directory)
   elif config.replay == 'chunks':
@@ -150,7 +153,9 @@ def make_envs(config, **overrides):
       ctor = bind(wrappers.RestartOnException, ctor)
     ctors.append(ctor)
   envs = [ctor() for ctor in ctors]
-  return embodied.BatchEnv(envs, parallel=(config.envs.parallel != 'none'))
+  parallel = config.envs.parallel != 'none'
+  shared = parallel and config.envs.shared
+  return embodied.BatchEnv(envs, parallel=parallel, shared=shared)
 
 
 def make_env(config, **overrides):
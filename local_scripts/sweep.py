@@ -0,0 +1,251 @@
+"""Runs the grid of main_local.sh in parallel on one machine.
+
+Every run trains and then evaluates one (task, seed, crossmodal, context,
+scheme) combination. Runs are packed onto the given GPUs and CPU cores, runs
+whose checkpoint already reached the final step skip training, and crashed
+runs are retried. The state of every run is kept in a JSON file next to a
+plain text status table, so an interrupted sweep continues where it stopped.
+
+  uv run local_scripts/sweep.py --gpus 0 1 --jobs_per_gpu 3 --cpus 32
+  uv run local_scripts/sweep.py --dry_run
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import pathlib
+import pickle
+import subprocess
+import sys
+import time
+
+SCHEMES = [
+    "enc_obs_dec_obs",
+    "enc_img_dec_img",
+    "enc_obs_ctx_dec_obs_ctx",
+    "enc_img_ctx_dec_img_ctx",
+    "enc_obs_dec_obs_pgm_ctx",
+    "enc_img_dec_img_pgm_ctx",
+    "enc_obs_dec_obs_ctxencoder_transformer",
+    "enc_img_dec_img_ctxencoder_transformer",
+    "enc_obs_dec_obs_ctxencoder_transformer_grssm",
+    "enc_img_dec_img_ctxencoder_transformer_grssm",
+]
+TASKS = {"carl_dmc_walker": 500000, "carl_dmc_ball_in_cup": 200000}
+SEEDS = ["0", "42", "1337", "13", "71", "1994", "1997", "908", "2102", "3"]
+CROSSMODAL = ["True", "False"]
+CONTEXTS = ["single_0", "single_1", "double_box"]
+
+# Threads per run. Image schemes also render and encode frames.
+CPUS = {"obs": 1, "img": 2}
+
+
+def make_jobs(args):
+    jobs = []
+    grid = itertools.product(args.tasks, args.seeds, CROSSMODAL, args.contexts, args.schemes)
+    for task, seed, crossmodal, context, scheme in grid:
+        # The default schemes only run once with the default context.
+        if scheme.endswith("_default"):
+            if context != CONTEXTS[0]:
+                continue
+            scheme, context = scheme[: -len("_default")], "default"
+        group = f"{task}_{context}_{scheme}_normalized"
+        root = "logs_dali_crossmodal" if crossmodal == "True" else "logs_dali"
+        logdir = f"{root}/{group}/{seed}"
+        platform = "gpu" if args.gpus else "cpu"
+        train = [
+            "-m", "contextual_mbrl.dreamer.train", "--configs", "carl", scheme,
+            "--jax.prealloc", "False", "--task", task, "--env.carl.context", context,
+            "--seed", seed, "--ctx_encoder.crossmodal", crossmodal,
+            "--logdir", logdir, "--wandb.project", "", "--wandb.group", group,
+            "--run.steps", str(TASKS[task]), "--jax.platform", platform,
+        ]
+        evaluate = [
+            "-m", "contextual_mbrl.dreamer.eval", "--logdir", logdir,
+            "--jax.platform", platform,
+        ]
+        jobs.append({
+            "name": logdir,
+            "logdir": logdir,
+            "steps": TASKS[task],
+            "cpus": CPUS["img" if "_img" in scheme else "obs"],
+            "stages": [("train", train), ("eval", evaluate)],
+        })
+    return jobs
+
+
+def checkpoint_step(logdir):
+    path = pathlib.Path(logdir) / "checkpoint.ckpt"
+    if not path.exists():
+        return 0
+    try:
+        with path.open("rb") as f:
+            return int(pickle.load(f)["step"])
+    except Exception:
+        return 0  # Partially written or from an older format, train again.
+
+
+class Sweep:
+    def __init__(self, jobs, args):
+        self.args = args
+        self.jobs = {job["name"]: job for job in jobs}
+        self.status_file = pathlib.Path(args.status)
+        self.status = {}
+        if self.status_file.exists():
+            self.status = json.loads(self.status_file.read_text())
+        for job in jobs:
+            entry = self.status.setdefault(
+                job["name"], {"stage": "train", "state": "pending", "attempts": 0}
+            )
+            # Runs that were still running when the last sweep stopped restart.
+            if entry["state"] == "running" or (
+                entry["state"] == "failed" and not args.keep_failed
+            ):
+                entry.update(state="pending", attempts=0)
+            if entry["stage"] == "train" and entry["state"] == "pending":
+                if checkpoint_step(job["logdir"]) >= job["steps"]:
+                    entry["stage"] = "eval"
+        self.pending = collections.deque(
+            name for name in self.jobs if self.status[name]["state"] == "pending"
+        )
+        self.running = {}
+        self.gpu_load = {gpu: 0 for gpu in args.gpus}
+        self.free_cpus = args.cpus
+
+    def run(self):
+        self.write()
+        while self.pending or self.running:
+            changed = self.poll()
+            changed = self.fill() or changed
+            if changed:
+                self.write()
+            time.sleep(self.args.poll)
+        self.write()
+
+    def poll(self):
+        changed = False
+        for name, (proc, gpu, log) in list(self.running.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            log.close()
+            del self.running[name]
+            self.free_cpus += self.jobs[name]["cpus"]
+            if gpu is not None:
+                self.gpu_load[gpu] -= 1
+            entry = self.status[name]
+            stages = [stage for stage, _ in self.jobs[name]["stages"]]
+            if code == 0:
+                index = stages.index(entry["stage"]) + 1
+                if index < len(stages):
+                    entry.update(stage=stages[index], state="pending", attempts=0)
+                    self.pending.appendleft(name)
+                else:
+                    entry.update(state="done")
+            elif entry["attempts"] <= self.args.retries:
+                entry.update(state="pending", code=code)
+                self.pending.append(name)
+            else:
+                entry.update(state="failed", code=code)
+            changed = True
+        return changed
+
+    def fill(self):
+        started = False
+        for _ in range(len(self.pending)):
+            name = self.pending.popleft()
+            job = self.jobs[name]
+            gpu = self.pick_gpu()
+            if job["cpus"] > self.free_cpus or (self.args.gpus and gpu is None):
+                self.pending.appendleft(name)
+                break
+            self.start(job, gpu)
+            started = True
+        return started
+
+    def pick_gpu(self):
+        if not self.args.gpus:
+            return None
+        gpu = min(self.gpu_load, key=self.gpu_load.get)
+        if self.gpu_load[gpu] >= self.args.jobs_per_gpu:
+            return None
+        return gpu
+
+    def start(self, job, gpu):
+        entry = self.status[job["name"]]
+        command = dict(job["stages"])[entry["stage"]]
+        threads = str(job["cpus"])
+        env = {
+            **os.environ,
+            "MUJOCO_GL": "egl",
+            "OMP_NUM_THREADS": threads,
+            "OPENBLAS_NUM_THREADS": threads,
+            "MKL_NUM_THREADS": threads,
+            "XLA_FLAGS": (
+                "--xla_force_host_platform_device_count=1 "
+                f"--xla_cpu_multi_thread_eigen={'true' if job['cpus'] > 1 else 'false'} "
+                f"intra_op_parallelism_threads={threads}"
+            ),
+        }
+        if gpu is not None:
+            env["CUDA_VISIBLE_DEVICES"] = str(gpu)
+            self.gpu_load[gpu] += 1
+        self.free_cpus -= job["cpus"]
+        pathlib.Path(job["logdir"]).mkdir(parents=True, exist_ok=True)
+        log = open(pathlib.Path(job["logdir"]) / f"sweep_{entry['stage']}.log", "a")
+        proc = subprocess.Popen(
+            [sys.executable] + command, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        entry.update(state="running", attempts=entry["attempts"] + 1, gpu=gpu)
+        self.running[job["name"]] = (proc, gpu, log)
+        print(f"Started {entry['stage']} of {job['name']} (gpu {gpu}).")
+
+    def write(self):
+        temp = self.status_file.with_suffix(".tmp")
+        temp.write_text(json.dumps(self.status, indent=1))
+        os.replace(temp, self.status_file)
+        counts = collections.Counter(
+            f"{self.status[name]['stage']}/{self.status[name]['state']}"
+            for name in self.jobs
+        )
+        lines = [f"{'run':<100} {'stage':<6} {'state':<8} attempts"]
+        for name in self.jobs:
+            entry = self.status[name]
+            lines.append(
+                f"{name:<100} {entry['stage']:<6} {entry['state']:<8} {entry['attempts']}"
+            )
+        lines.append("")
+        lines += [f"{key}: {count}" for key, count in sorted(counts.items())]
+        self.status_file.with_suffix(".txt").write_text("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--gpus", nargs="*", type=int, default=[0])
+    parser.add_argument("--jobs_per_gpu", type=int, default=2)
+    parser.add_argument("--cpus", type=int, default=os.cpu_count())
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--poll", type=float, default=10.0)
+    parser.add_argument("--status", type=str, default="sweep_status.json")
+    parser.add_argument("--keep_failed", action="store_true")
+    parser.add_argument("--dry_run", action="store_true")
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS))
+    parser.add_argument("--seeds", nargs="+", default=SEEDS)
+    parser.add_argument("--contexts", nargs="+", default=CONTEXTS)
+    parser.add_argument("--schemes", nargs="+", default=SCHEMES)
+    args = parser.parse_args()
+
+    os.chdir(pathlib.Path(__file__).resolve().parent.parent)
+    jobs = make_jobs(args)
+    if args.dry_run:
+        for job in jobs:
+            print(job["name"], job["cpus"], "cpus")
+        print(f"{len(jobs)} runs.")
+        return
+    Sweep(jobs, args).run()
+
+
+if __name__ == "__main__":
+    main()